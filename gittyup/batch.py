@@ -0,0 +1,97 @@
+#
+# batch.py
+#
+
+import cPickle
+from multiprocessing import Pool, cpu_count
+
+from gittyup.client import GittyupClient, GittyupSharedState
+from gittyup.hashing import BlobHasher
+
+# Set in each worker process by the pool initializer
+_shared_state = None
+
+def _initialize_worker(shared_state):
+    global _shared_state
+    _shared_state = shared_state
+
+def _get_status(path):
+    """
+    Get the status of one repository
+
+    @rtype  tuple
+    @return A (path, statuses, error) tuple.  statuses is None and error is
+        the exception if the status couldn't be read.
+
+    """
+
+    try:
+        client = GittyupClient(path, shared_state=_shared_state)
+
+        # Each repository already has a process to itself
+        client._hasher = BlobHasher(1)
+
+        return (path, client.status(), None)
+    except Exception, e:
+        # The error is sent back to the parent process, which can only
+        # happen if it pickles
+        try:
+            cPickle.dumps(e)
+        except Exception:
+            e = Exception(str(e))
+
+        return (path, None, e)
+
+def status_many(paths, workers=None, shared_state=None):
+    """
+    Get the status of many repositories on a pool of processes.  The global
+    and system config files and the global excludes file are read once, in
+    the calling process, and shared with the workers.
+
+    @type   paths: list
+    @param  paths: Repository paths
+
+    @type   workers: int
+    @param  workers: The number of worker processes.  Defaults to the number
+        of CPUs.
+
+    @type   shared_state: GittyupSharedState
+    @param  shared_state: Already loaded global state to use
+
+    @rtype  iterator
+    @return (path, statuses, error) tuples, in the order the repositories
+        finish.  statuses is the list returned by GittyupClient.status(),
+        or None if the status couldn't be read, in which case error is the
+        exception that was raised.
+
+    """
+
+    if workers is None:
+        try:
+            workers = cpu_count()
+        except NotImplementedError:
+            workers = 1
+
+    if shared_state is None:
+        shared_state = GittyupSharedState()
+
+    # Read the excludes file here, once, rather than once per worker
+    excludesfile = shared_state.get_excludesfile()
+    if excludesfile:
+        shared_state.get_excludes_patterns(excludesfile)
+
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        _initialize_worker(shared_state)
+        for path in paths:
+            yield _get_status(path)
+        return
+
+    pool = Pool(workers, _initialize_worker, (shared_state,))
+    try:
+        for result in pool.imap_unordered(_get_status, paths):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
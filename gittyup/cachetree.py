@@ -0,0 +1,162 @@
+#
+# cachetree.py
+#
+
+import stat
+
+import dulwich.objects
+from dulwich.index import cleanup_mode
+
+from gittyup.util import get_path_bounds, read_data_file, write_data_file
+
+CACHE_TREE_VERSION = 2
+
+def _is_valid_tree(rel_dir, record):
+    """
+    Check the shape of a directory's cached tree as read from the cache
+    file
+
+    """
+
+    (tree_id, entry_count) = record
+    return (type(rel_dir) == str and type(tree_id) == str and len(tree_id) == 40
+        and type(entry_count) in (int, long))
+
+class CacheTree:
+    def __init__(self, path):
+        """
+        Remembers the tree id of each directory in the index, like git's
+        cache-tree index extension, so a commit only builds the trees of
+        directories that have changed.  The cache is stored in a file in the
+        git control directory, along with the checksum of the index it
+        describes.  If the index has been changed by anything that didn't
+        update the cache, the checksum won't match and the cache is thrown
+        away.
+
+        @type   path: string
+        @param  path: The cache file
+
+        """
+
+        self.path = path
+        self.index_checksum = None
+        self.trees = {}
+        self.dirty = False
+        self.read()
+
+    def read(self):
+        data = read_data_file(self.path)
+        if data is None:
+            return
+
+        # A cache that isn't in the expected shape is just rebuilt
+        try:
+            (version, index_checksum, trees) = data
+            if version != CACHE_TREE_VERSION:
+                return
+            if index_checksum is not None and type(index_checksum) != str:
+                return
+            for (rel_dir, record) in trees.items():
+                if not _is_valid_tree(rel_dir, record):
+                    return
+        except (TypeError, ValueError, AttributeError):
+            return
+
+        self.index_checksum = index_checksum
+        self.trees = trees
+
+    def write(self):
+        """
+        Write the cache atomically, if anything has changed
+
+        """
+
+        if not self.dirty:
+            return
+
+        write_data_file(self.path, (CACHE_TREE_VERSION, self.index_checksum, self.trees))
+        self.dirty = False
+
+    def set_index_checksum(self, index_checksum):
+        """
+        Record the index the cache now describes.  Anything cached for a
+        different index is forgotten.
+
+        """
+
+        if index_checksum != self.index_checksum:
+            self.index_checksum = index_checksum
+            self.dirty = True
+
+    def clear(self):
+        if self.trees:
+            self.trees = {}
+            self.dirty = True
+
+    def invalidate(self, path):
+        """
+        Forget the trees of the directories containing an index entry that
+        has been added, changed or removed
+
+        @type   path: string
+        @param  path: A repository-relative path
+
+        """
+
+        rel_dir = path
+        while rel_dir:
+            rel_dir = rel_dir.rpartition("/")[0]
+            if rel_dir in self.trees:
+                del self.trees[rel_dir]
+                self.dirty = True
+
+    def build(self, object_store, entries):
+        """
+        Build the root tree of an index.  Directories that are still cached
+        are reused, and only the others are built and added to the object
+        store.
+
+        @type   object_store: ObjectStore
+        @param  object_store: Where new trees are added
+
+        @type   entries: dict
+        @param  entries: The index entries, by path
+
+        @rtype  string
+        @return The root tree id
+
+        """
+
+        paths = sorted(entries)
+
+        def build_tree(prefix, start, end):
+            rel_dir = prefix[:-1]
+
+            # The entry count is checked as well, in case the cache missed
+            # a change
+            cached = self.trees.get(rel_dir)
+            if cached is not None and cached[1] == end - start:
+                return cached[0]
+
+            tree = dulwich.objects.Tree()
+            i = start
+            while i < end:
+                name = paths[i][len(prefix):]
+                slash = name.find("/")
+                if slash < 0:
+                    entry = entries[paths[i]]
+                    tree.add(name, cleanup_mode(entry[4]), entry[8])
+                    i += 1
+                else:
+                    # Everything in a subdirectory sorts together
+                    name = name[:slash]
+                    j = get_path_bounds(paths, prefix + name, i, end)[2]
+                    tree.add(name, stat.S_IFDIR, build_tree(prefix + name + "/", i, j))
+                    i = j
+
+            object_store.add_object(tree)
+            self.trees[rel_dir] = (tree.id, end - start)
+            self.dirty = True
+            return tree.id
+
+        return build_tree("", 0, len(paths))
@@ -4,21 +4,31 @@
 
 import os
 import re
+import stat
+import errno
 import shutil
-import fnmatch
+import hashlib
+from collections import deque
+from contextlib import contextmanager
 from time import time, timezone
 
 import dulwich.errors
 import dulwich.repo
 import dulwich.objects
 from dulwich.pack import Pack
-from dulwich.index import commit_index, write_index_dict, SHA1Writer
+from dulwich.index import write_index_dict, SHA1Writer
 
 from gittyup.exceptions import *
 import gittyup.util
 from gittyup.objects import *
-from gittyup.config import GittyupLocalFallbackConfig
+from gittyup.config import GittyupLocalFallbackConfig, GittyupGlobalConfig, GittyupSystemConfig
 from gittyup.command import GittyupCommand
+from gittyup.ignore import IgnoreMatcher, read_ignore_patterns
+from gittyup.hashing import BlobHasher, store_blob_file
+from gittyup.untracked import UntrackedCache
+from gittyup.pack import PackWriter, compress_blob
+from gittyup.cachetree import CacheTree
+from gittyup.index import GittyupIndex, SPLIT_INDEX_MAX_PERCENT_CHANGE
 
 TZ = -1 * timezone
 ENCODING = "UTF-8"
@@ -28,23 +38,103 @@ DULWICH_TREE_TYPE = 2
 DULWICH_BLOB_TYPE = 3
 DULWICH_TAG_TYPE = 4
 
+# Staging at least this many new blobs writes them into one pack file
+# rather than one loose object each
+PACK_THRESHOLD = 256
+
+# Files this large are streamed into the object store rather than read
+# into memory, unless core.bigfilethreshold says otherwise
+STREAM_THRESHOLD = 1048576
+
+SIZE_UNITS = {"k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024}
+
 def callback_notify_null(val):
     pass
 
+class GittyupSharedState:
+    def __init__(self):
+        """
+        State that is the same for every repository: the parsed global and
+        system git config files, and the patterns read from the
+        core.excludesfile they name.  Clients created with the same shared
+        state don't read these files again.
+        
+        """
+        
+        self.global_config = GittyupGlobalConfig()
+        self.system_config = GittyupSystemConfig()
+        self.excludes_patterns = {}
+
+    def get_excludesfile(self):
+        """
+        Get the core.excludesfile named by the system or global config, or
+        None.  As in GittyupLocalFallbackConfig, the system config is
+        checked first.
+        
+        """
+        
+        for config in (self.system_config, self.global_config):
+            if config.has("core", "excludesfile"):
+                excludesfile = config.get("core", "excludesfile")
+                if excludesfile:
+                    return os.path.expanduser(excludesfile)
+        
+        return None
+
+    def get_excludes_patterns(self, path):
+        """
+        Get the patterns in an excludes file, reading it the first time
+        
+        """
+        
+        if path not in self.excludes_patterns:
+            self.excludes_patterns[path] = read_ignore_patterns(path)
+        
+        return self.excludes_patterns[path]
+
+class _IndexTransaction:
+    def __init__(self, index, old_checksum):
+        """
+        The state of an index_transaction(): the index every operation
+        works on, the checksum of the index file it was read from, and the
+        paths that have changed so far
+        
+        """
+        
+        self.index = index
+        self.old_checksum = old_checksum
+        self.changed_paths = []
+
+    def add_changes(self, changed_paths):
+        if self.changed_paths is None:
+            return
+        
+        if changed_paths is None:
+            self.changed_paths = None
+        else:
+            self.changed_paths += changed_paths
+
 class GittyupClient:
-    def __init__(self, path=None, create=False):
+    def __init__(self, path=None, create=False, shared_state=None):
         self.callback_notify = callback_notify_null
+        self.shared_state = shared_state
         self.global_ignore_patterns = []
+        self.global_ignore_matcher = IgnoreMatcher([])
+        self._gitignore_cache = {}
+        self._untracked_cache = None
+        self._staged_cache = None
+        self._cache_tree = None
+        self._transaction = None
+        self._hasher = BlobHasher()
         
         if path:
             try:
                 self.repo = dulwich.repo.Repo(os.path.realpath(path))
                 self._load_config()
-                self.global_ignore_patterns = self._get_global_ignore_patterns()
+                self._load_global_ignore_patterns()
             except dulwich.errors.NotGitRepository:
                 if create:
                     self.initialize_repository(path)
-                    self.global_ignore_patterns = self._get_global_ignore_patterns()
                 else:
                     raise NotRepositoryError()
         else:
@@ -63,11 +153,219 @@ class GittyupClient:
         finally:
             f.close()
 
+    def _write_index(self, index, changed_paths=None):
+        """
+        Write the index atomically.  The new contents are written to
+        index.lock, which is created exclusively so that a concurrent writer
+        fails instead of interleaving, and then renamed over the index.
+        
+        If core.splitindex is true, only the entries that differ from a
+        shared index are written, until so many differ that a new shared
+        index is written.
+        
+        Within an index_transaction(), nothing is written until the
+        transaction ends.
+        
+        @type   changed_paths: list
+        @param  changed_paths: The paths whose entries were added, removed,
+            or given a new blob or mode, so that only their directories'
+            cached trees are forgotten.  If None, all of them are.
+        
+        """
+        
+        if self._transaction is not None:
+            self._transaction.add_changes(changed_paths)
+            return
+        
+        fd = self._lock_index()
+        self._write_locked_index(fd, index, changed_paths)
+
+    def _lock_index(self):
+        """
+        Create index.lock exclusively
+        
+        @rtype  int
+        @return The lock file's descriptor
+        
+        """
+        
+        lock_path = self.repo.index_path() + ".lock"
+        try:
+            return os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                raise IndexLockedError("%s exists, another process may be using the index" % lock_path)
+            raise
+
+    def _unlock_index(self, fd):
+        """
+        Release index.lock without writing the index
+        
+        """
+        
+        os.close(fd)
+        os.remove(self.repo.index_path() + ".lock")
+
+    def _write_locked_index(self, fd, index, changed_paths=None):
+        """
+        Write the index to the held index.lock, bring the cache tree up to
+        date, and rename index.lock over the index.  The cache tree is
+        written while the lock is still held, so no other writer can change
+        the index in between.
+        
+        @type   changed_paths: list
+        @param  changed_paths: See _write_index()
+        
+        """
+        
+        index_path = self.repo.index_path()
+        lock_path = index_path + ".lock"
+        try:
+            f = SHA1Writer(os.fdopen(fd, "wb"))
+            try:
+                # If another writer changed the index after this one was
+                # read, the cached trees can't be brought up to date from
+                # changed_paths
+                old_checksum = self._get_index_checksum()
+                if old_checksum != index.checksum:
+                    changed_paths = None
+                
+                if self.config.get("core", "splitindex") == "true":
+                    index.write_split_index(f, self._get_split_changes(index))
+                else:
+                    write_index_dict(f, index._byname)
+            except:
+                f.f.close()
+                raise
+            checksum = f.close()
+            
+            self._update_cache_tree(old_checksum, changed_paths, checksum)
+            os.rename(lock_path, index_path)
+        except:
+            os.remove(lock_path)
+            raise
+        
+        index.checksum = checksum
+
+    def _get_split_changes(self, index):
+        """
+        Get the changes to write to a split index, first writing a new
+        shared index if there isn't one or the changes have grown to more
+        than splitindex.maxpercentchange percent of its entries
+        
+        """
+        
+        max_percent = SPLIT_INDEX_MAX_PERCENT_CHANGE
+        if self.config.has("splitindex", "maxpercentchange"):
+            max_percent = int(self.config.get("splitindex", "maxpercentchange"))
+        
+        changes = index.get_split_changes()
+        if changes is not None:
+            (deleted, replaced, added) = changes
+            change_count = len(deleted) + len(replaced) + len(added)
+            if change_count * 100 <= len(index.shared_names) * max_percent:
+                return changes
+        
+        index.write_shared_index()
+        return ([], [], [])
+
+    def _get_index_checksum(self):
+        """
+        Get the SHA-1 at the end of the index file, which identifies its
+        contents, or None if there is no index
+        
+        """
+        
+        try:
+            file = open(self.repo.index_path(), "rb")
+        except IOError:
+            return None
+        
+        try:
+            try:
+                file.seek(-20, 2)
+            except IOError:
+                return None
+            return file.read(20)
+        finally:
+            file.close()
+
+    def _get_cache_tree(self):
+        if self._cache_tree is None:
+            self._cache_tree = CacheTree(os.path.join(self.repo.controldir(), "gittyup-cache-tree"))
+        
+        return self._cache_tree
+
+    def _update_cache_tree(self, old_checksum, changed_paths, new_checksum):
+        """
+        Bring the cache tree up to date for a new index
+        
+        @type   old_checksum: string
+        @param  old_checksum: The checksum of the index being replaced.  If
+            the cache doesn't describe that index, it is cleared.
+        
+        @type   changed_paths: list
+        @param  changed_paths: See _write_index()
+        
+        @type   new_checksum: string
+        @param  new_checksum: The checksum of the new index
+        
+        """
+        
+        cache = self._get_cache_tree()
+        if changed_paths is None or cache.index_checksum != old_checksum:
+            cache.clear()
+        else:
+            for path in changed_paths:
+                cache.invalidate(path)
+        
+        cache.set_index_checksum(new_checksum)
+        cache.write()
+
+    def _commit_index(self):
+        """
+        Build and store the trees of the index, reusing the cached trees of
+        directories that haven't changed
+        
+        @rtype  string
+        @return The root tree id
+        
+        """
+        
+        if self._transaction is not None:
+            # The index hasn't been written yet, so a copy of the cache is
+            # used and thrown away, in case the transaction is rolled back
+            cache = CacheTree(self._get_cache_tree().path)
+            if cache.index_checksum != self._transaction.old_checksum or self._transaction.changed_paths is None:
+                cache.clear()
+            else:
+                for path in self._transaction.changed_paths:
+                    cache.invalidate(path)
+            return cache.build(self.repo.object_store, self._transaction.index._byname)
+        
+        cache = self._get_cache_tree()
+        
+        # The checksum of the index that was read is used, so the cache
+        # can't be given trees built from a different index than the one it
+        # is recorded for
+        index = self._get_index()
+        if cache.index_checksum != index.checksum:
+            cache.clear()
+            cache.set_index_checksum(index.checksum)
+        
+        tree_id = cache.build(self.repo.object_store, index._byname)
+        cache.write()
+        
+        return tree_id
+
     def _get_index(self):
+        if self._transaction is not None:
+            return self._transaction.index
+        
         if self.repo.has_index() == False:
             self._initialize_index()
         
-        return self.repo.open_index()
+        return GittyupIndex(self.repo.index_path())
     
     def _get_tree_at_head(self):
         try:
@@ -78,7 +376,7 @@ class GittyupClient:
         return tree
 
     def _get_working_tree(self):
-        return self.repo[commit_index(self.repo.object_store, self._get_index())]
+        return self.repo[self._commit_index()]
 
     def _get_tree_index(self, tree=None):
         if tree is None:
@@ -90,114 +388,845 @@ class GittyupClient:
                 tree_index[item[0]] = (item[1], item[2])
         return tree_index
 
+    def _iter_tree_sorted(self, tree, prefix=""):
+        """
+        Yield (path, mode, sha) tuples for every blob below a tree, sorted by
+        path in the same order as the index
+        
+        @type   tree: dulwich.objects.Tree
+        @param  tree: The tree to walk
+        
+        @type   prefix: string
+        @param  prefix: The path of the tree, including a trailing "/"
+        
+        """
+        
+        # Git sorts a subtree as if its name ended with "/", which makes a
+        # depth-first walk come out in full path order
+        entries = []
+        for (name, mode, sha) in tree.iteritems():
+            if stat.S_ISDIR(mode):
+                entries.append((name + "/", name, mode, sha))
+            else:
+                entries.append((name, name, mode, sha))
+        entries.sort()
+        
+        for (key, name, mode, sha) in entries:
+            if stat.S_ISDIR(mode):
+                for item in self._iter_tree_sorted(self.repo[sha], prefix + key):
+                    yield item
+            else:
+                yield (prefix + name, mode, sha)
+
+    def _iter_tree_sorted_at(self, tree, path):
+        """
+        Yield (path, mode, sha) tuples for the blob at a repository-relative
+        path, or for every blob below it if it is a tree.  Only the subtree
+        leading to the path is read.
+        
+        """
+        
+        if path == "":
+            for item in self._iter_tree_sorted(tree):
+                yield item
+            return
+        
+        parts = path.split("/")
+        for (i, part) in enumerate(parts):
+            try:
+                (mode, sha) = tree[part]
+            except KeyError:
+                return
+            
+            if stat.S_ISDIR(mode):
+                tree = self.repo[sha]
+            elif i == len(parts) - 1:
+                yield (path, mode, sha)
+                return
+            else:
+                return
+        
+        for item in self._iter_tree_sorted(tree, path + "/"):
+            yield item
+
+    def _merge_status_streams(self, tree_entries, index_paths, working_entries):
+        """
+        Merge-join three path-sorted streams in a single pass
+        
+        @type   tree_entries: iterable
+        @param  tree_entries: (path, mode, sha) tuples from HEAD
+        
+        @type   index_paths: iterable
+        @param  index_paths: Paths in the index
+        
+        @type   working_entries: iterable
+        @param  working_entries: (path, stat_result, d_type) tuples from
+            the working tree
+        
+        @rtype  generator
+        @return (path, tree_entry, in_index, working_entry) tuples in path
+            order.  tree_entry is None if the path is not in HEAD, and
+            working_entry is None if it is not in the working tree.
+        
+        """
+        
+        tree_entries = iter(tree_entries)
+        index_paths = iter(index_paths)
+        working_entries = iter(working_entries)
+        
+        tree_entry = next(tree_entries, None)
+        index_path = next(index_paths, None)
+        working_entry = next(working_entries, None)
+        
+        while tree_entry is not None or index_path is not None or working_entry is not None:
+            candidates = []
+            if index_path is not None:
+                candidates.append(index_path)
+            if working_entry is not None:
+                candidates.append(working_entry[0])
+            if tree_entry is not None:
+                candidates.append(tree_entry[0])
+            path = min(candidates)
+            
+            current_tree_entry = None
+            if tree_entry is not None and tree_entry[0] == path:
+                current_tree_entry = tree_entry
+                tree_entry = next(tree_entries, None)
+            
+            in_index = (index_path == path)
+            if in_index:
+                index_path = next(index_paths, None)
+            
+            current_working_entry = None
+            if working_entry is not None and working_entry[0] == path:
+                current_working_entry = working_entry
+                working_entry = next(working_entries, None)
+            
+            yield (path, current_tree_entry, in_index, current_working_entry)
+
     def _get_global_ignore_patterns(self):
         """
-        Get ignore patterns from $GIT_DIR/info/exclude then from
-        core.excludesfile in gitconfig.
+        Get ignore patterns from core.excludesfile in gitconfig then from
+        $GIT_DIR/info/exclude.  The last matching pattern wins, so the
+        patterns from $GIT_DIR/info/exclude take precedence.
+        
+        """
+        
+        patterns = []
+        try:
+            core_excludesfile = self.config.get("core", "excludesfile")
+            if core_excludesfile:
+                patterns += self._get_excludesfile_patterns(os.path.expanduser(core_excludesfile))
+        except KeyError:
+            pass
+
+        try:
+            git_dir = os.environ["GIT_DIR"]
+        except KeyError:
+            git_dir = self.repo.controldir()
+
+        excludefile = os.path.join(git_dir, "info", "exclude")
+        if os.path.isfile(excludefile):
+            patterns += self._get_ignore_patterns_from_file(excludefile)
+
+        return patterns
+
+    def _load_global_ignore_patterns(self):
+        self.global_ignore_patterns = self._get_global_ignore_patterns()
+        self.global_ignore_matcher = IgnoreMatcher(self.global_ignore_patterns)
+        self._gitignore_cache = {}
+        self._untracked_cache = None
+        self._staged_cache = None
+    
+    def _get_ignore_patterns_from_file(self, path):
+        """
+        Read in an ignore patterns file (i.e. .gitignore, $GIT_DIR/info/exclude)
+        and return a list of patterns
+        """
+        
+        return read_ignore_patterns(path)
+
+    def _get_excludesfile_patterns(self, path):
+        """
+        Read the core.excludesfile, or take its patterns from the shared
+        state if it has already been read
+        
+        """
+        
+        if self.shared_state is None:
+            return self._get_ignore_patterns_from_file(path)
+        
+        return self.shared_state.get_excludes_patterns(path)
+
+    def _ignore_file(self, matchers, path, is_dir=False):
+        """
+        Determine whether the given file should be ignored
+        
+        @type   matchers: list
+        @param  matchers: IgnoreMatcher objects, from lowest to highest
+            precedence
+        
+        @type   path: string
+        @param  path: A repository-relative path
+        
+        @type   is_dir: boolean
+        @param  is_dir: Whether the path is a directory
+        
+        """
+        
+        for matcher in reversed(matchers):
+            ignored = matcher.match(path, is_dir)
+            if ignored is not None:
+                return ignored
+
+        return False
+    
+    def _get_gitignore_matcher(self, rel_dir, seen=None):
+        """
+        Get the compiled patterns of the .gitignore file in rel_dir.  Parsed
+        files are cached by path and reused across walks until their mtime
+        or size changes.
+        
+        @type   rel_dir: string
+        @param  rel_dir: A repository-relative directory
+        
+        @type   seen: set
+        @param  seen: The directories whose .gitignore files were used by
+            the current walk
+        
+        @rtype  IgnoreMatcher
+        @return The compiled patterns, or None if there is no .gitignore file
+        
+        """
+        
+        gitignore = os.path.join(self.repo.path, rel_dir, ".gitignore")
+        try:
+            st = os.stat(gitignore)
+        except OSError:
+            return None
+        
+        key = (st.st_mtime, st.st_size)
+        cached = self._gitignore_cache.get(rel_dir)
+        if cached is None or cached[0] != key:
+            matcher = IgnoreMatcher(self._get_ignore_patterns_from_file(gitignore), rel_dir)
+            cached = (key, matcher)
+            self._gitignore_cache[rel_dir] = cached
+        
+        if seen is not None:
+            seen.add(rel_dir)
+        return cached[1]
+
+    def _get_ignore_matchers(self, rel_dir, seen=None):
+        """
+        Build the list of ignore matchers that apply to the entries of a
+        directory, from the .gitignore files of the directory and all of its
+        ancestors
+        
+        @type   rel_dir: string
+        @param  rel_dir: A repository-relative directory
+        
+        @type   seen: set
+        @param  seen: See _get_gitignore_matcher()
+        
+        @rtype  list or None
+        @return A list of IgnoreMatcher objects, or None if the directory
+            or one of its ancestors is ignored
+        
+        """
+        
+        matchers = [self.global_ignore_matcher]
+        current = ""
+        parts = []
+        if rel_dir:
+            parts = rel_dir.split("/")
+        
+        while True:
+            matcher = self._get_gitignore_matcher(current, seen)
+            if matcher is not None:
+                matchers = matchers + [matcher]
+            
+            if not parts:
+                break
+            
+            current = os.path.join(current, parts.pop(0))
+            if self._ignore_file(matchers, current, True):
+                return None
+        
+        return matchers
+
+    def _get_untracked_cache(self):
+        """
+        Get the persistent untracked cache, unless core.untrackedcache is
+        set to false
+        
+        @rtype  UntrackedCache or None
+        
+        """
+        
+        if self._untracked_cache is None:
+            if self.config.get("core", "untrackedcache") == "false":
+                return None
+            
+            ignore_key = hashlib.sha1("\n".join(self.global_ignore_patterns)).hexdigest()
+            self._untracked_cache = UntrackedCache(
+                os.path.join(self.repo.controldir(), "gittyup-untracked-cache"),
+                ignore_key
+            )
+        
+        return self._untracked_cache
+
+    def _add_gitignore_matcher(self, rel_dir, matchers, ignore_key, seen):
+        """
+        Add a directory's .gitignore file, if it has one, to its inherited
+        ignore matchers
+        
+        @rtype  tuple
+        @return (matchers, ignore_key).  ignore_key identifies the state of
+            every .gitignore file in matchers.
+        
+        """
+        
+        matcher = self._get_gitignore_matcher(rel_dir, seen)
+        if matcher is None:
+            return (matchers, ignore_key)
+        
+        return (matchers + [matcher], ignore_key + ((rel_dir, self._gitignore_cache[rel_dir][0]),))
+
+    def _list_directory(self, rel_dir, listing, matchers, ignored=None):
+        """
+        Return the unignored entries of a directory as sorted
+        (sort key, name, d_type) tuples.  Directories sort as if their names
+        ended with "/", which makes a depth-first walk come out in full path
+        order.  Symlinks are files, as in git, and anything that isn't a
+        directory, regular file or symlink is left out.
+        
+        @type   listing: list
+        @param  listing: (name, stat_result, d_type) tuples from
+            gittyup.util.scan_directory()
+        
+        @type   ignored: list
+        @param  ignored: If given, (path, is_dir) tuples for the ignored
+            entries are appended to it
+        
+        """
+        
+        entries = []
+        for (name, st, d_type) in listing:
+            if d_type == gittyup.util.DT_UNKNOWN or name == ".git":
+                continue
+            
+            is_dir = (d_type == gittyup.util.DT_DIR)
+            if matchers is not None and self._ignore_file(matchers, os.path.join(rel_dir, name), is_dir):
+                if ignored is not None:
+                    ignored.append((os.path.join(rel_dir, name), is_dir))
+                continue
+            
+            if is_dir:
+                entries.append((name + "/", name, d_type))
+            else:
+                entries.append((name, name, d_type))
+        
+        entries.sort()
+        return entries
+
+    def _iter_directory_tree(self, rel_dir, matchers, ignore_key, directories, seen=None, read_gitignore=True, ignored=None, index_paths=None):
+        """
+        Recursively yield (path, stat_result, d_type) tuples for the
+        unignored files below a directory, in the same order as the index.
+        path is repository-relative, and stat_result is the file's lstat()
+        result if the walk had to read it, or None.  Ignored directories are
+        not descended into.  Directories that haven't changed since the last
+        walk are read from the untracked cache.
+        
+        @type   rel_dir: string
+        @param  rel_dir: A repository-relative directory
+        
+        @type   matchers: list
+        @param  matchers: The ignore matchers inherited from the parent
+            directory, or None to include ignored files
+        
+        @type   ignore_key: tuple
+        @param  ignore_key: Identifies the .gitignore files in matchers
+        
+        @type   directories: list
+        @param  directories: Unignored directories are appended to this list
+        
+        @type   seen: set
+        @param  seen: See _get_gitignore_matcher()
+        
+        @type   read_gitignore: boolean
+        @param  read_gitignore: Whether rel_dir's own .gitignore still has to
+            be added to matchers
+        
+        @type   ignored: list
+        @param  ignored: See _list_directory().  The untracked cache doesn't
+            remember ignored entries, so it isn't used if this is given.
+        
+        @type   index_paths: list
+        @param  index_paths: The sorted paths in the index.  If given, a
+            directory with nothing in the index below it is yielded as a
+            single (path, None, DT_DIR) tuple, as long as it holds at least
+            one unignored file, and is not descended into.
+        
+        """
+        
+        cache = None
+        if matchers is not None and ignored is None:
+            cache = self._get_untracked_cache()
+        
+        record = None
+        if cache is not None:
+            try:
+                mtime = os.stat(os.path.join(self.repo.path, rel_dir)).st_mtime
+            except OSError:
+                return
+            
+            record = cache.get(rel_dir, mtime)
+            if record is not None:
+                (has_gitignore, cached_ignore_key, entries) = record
+                if has_gitignore and read_gitignore:
+                    (matchers, ignore_key) = self._add_gitignore_matcher(rel_dir, matchers, ignore_key, seen)
+                    read_gitignore = False
+                
+                # A changed .gitignore file doesn't change the mtime
+                if cached_ignore_key != ignore_key:
+                    record = None
+        
+        # lstat() results from listing the directory, so files needn't be
+        # stat()ed again
+        stats = {}
+        
+        if record is None:
+            try:
+                listing = list(gittyup.util.scan_directory(os.path.join(self.repo.path, rel_dir)))
+            except OSError:
+                return
+            
+            has_gitignore = False
+            for (name, st, d_type) in listing:
+                if st is not None:
+                    stats[name] = st
+                if name == ".gitignore":
+                    has_gitignore = True
+            
+            if matchers is not None and has_gitignore and read_gitignore:
+                (matchers, ignore_key) = self._add_gitignore_matcher(rel_dir, matchers, ignore_key, seen)
+            
+            entries = self._list_directory(rel_dir, listing, matchers, ignored)
+            if cache is not None:
+                cache.set(rel_dir, mtime, has_gitignore, ignore_key, entries)
+        
+        for (key, name, d_type) in entries:
+            rel_path = os.path.join(rel_dir, name)
+            if d_type != gittyup.util.DT_DIR:
+                yield (rel_path, stats.get(name), d_type)
+                continue
+            
+            # Only entries below the directory count, not a tracked file
+            # of the same name that it has replaced
+            if index_paths is not None and self._has_no_paths_below(index_paths, rel_path):
+                if self._has_working_file(rel_path, matchers, ignore_key, seen):
+                    yield (rel_path, None, d_type)
+                continue
+            
+            directories.append(rel_path)
+            for child in self._iter_directory_tree(rel_path, matchers, ignore_key, directories, seen, True, ignored, index_paths):
+                yield child
+
+    def _has_no_paths_below(self, sorted_paths, rel_dir):
+        """
+        Determine whether nothing in a sorted list of paths is below a
+        directory.  The directory's own path doesn't count.
+        
+        """
+        
+        (exact, start, end) = gittyup.util.get_path_bounds(sorted_paths, rel_dir)
+        return start == end
+
+    def _has_working_file(self, rel_dir, matchers, ignore_key, seen=None, read_gitignore=True):
+        """
+        Determine whether there is an unignored file anywhere below a
+        directory.  The walk stops at the first one.
+        
+        """
+        
+        for working_entry in self._iter_directory_tree(rel_dir, matchers, ignore_key, [], seen, read_gitignore):
+            return True
+        
+        return False
+
+    def _iter_working_tree(self, rel_path, directories, show_ignored_files=False, ignored=None, index_paths=None):
+        """
+        Yield (path, stat_result, d_type) tuples for the unignored working
+        tree files at or below a repository-relative path, which may be a
+        file or a directory, in the same order as the index.  Directories
+        are appended to the given list, with rel_path itself last.
+        
+        If an ignored list is given, (path, is_dir) tuples for the ignored
+        files and directories that were skipped are appended to it.  Ignored
+        directories are not descended into.
+        
+        If sorted index_paths are given, wholly untracked directories are
+        collapsed into one entry, as described in _iter_directory_tree().
+        
+        """
+        
+        absolute_path = self.get_absolute_path(rel_path)
+        try:
+            st = os.lstat(absolute_path)
+        except OSError:
+            return
+        
+        d_type = gittyup.util.get_d_type(st.st_mode)
+        if d_type == gittyup.util.DT_DIR:
+            matchers = None
+            ignore_key = ()
+            seen = set()
+            if not show_ignored_files:
+                matchers = self._get_ignore_matchers(rel_path, seen)
+                if matchers is None:
+                    if ignored is not None:
+                        ignored.append((rel_path, True))
+                    return
+                
+                for matcher in matchers[1:]:
+                    ignore_key += ((matcher.base, self._gitignore_cache[matcher.base][0]),)
+            
+            if index_paths is not None and rel_path != "" and self._has_no_paths_below(index_paths, rel_path):
+                if self._has_working_file(rel_path, matchers, ignore_key, seen, False):
+                    yield (rel_path, None, d_type)
+                return
+            
+            for working_entry in self._iter_directory_tree(rel_path, matchers, ignore_key, directories, seen, False, ignored, index_paths):
+                yield working_entry
+            
+            directories.append(rel_path)
+            
+            if not show_ignored_files:
+                cache = self._get_untracked_cache()
+                
+                # Only keep the .gitignore files and directories that still
+                # exist.  Collapsed directories are only partly walked, so
+                # what was not seen may still exist.
+                if rel_path == "" and index_paths is None:
+                    for cached_dir in self._gitignore_cache.keys():
+                        if cached_dir not in seen:
+                            del self._gitignore_cache[cached_dir]
+                    
+                    if cache is not None:
+                        cache.prune(set(directories))
+                
+                if cache is not None:
+                    cache.write()
+        elif d_type != gittyup.util.DT_UNKNOWN:
+            if not show_ignored_files:
+                matchers = self._get_ignore_matchers(os.path.dirname(rel_path))
+                if matchers is None or self._ignore_file(matchers, rel_path):
+                    if ignored is not None:
+                        ignored.append((rel_path, False))
+                    return
+            
+            yield (rel_path, st, d_type)
+
+    def _get_status_scopes(self, paths):
+        """
+        Convert the paths given to status() into a sorted list of
+        repository-relative paths, none of which contains another
+        
+        @rtype  list or None
+        @return A list of paths, or None if the whole repository is wanted
+        
+        """
+        
+        if len(paths) == 0:
+            return None
+        
+        relative_paths = []
+        for path in paths:
+            if not path or os.path.realpath(path) == self.repo.path:
+                return None
+            relative_paths.append(self.get_relative_path(os.path.abspath(path)))
+        relative_paths.sort()
+        
+        scopes = []
+        for relative_path in relative_paths:
+            if scopes and (relative_path == scopes[-1] or relative_path.startswith(scopes[-1] + "/")):
+                continue
+            scopes.append(relative_path)
+        
+        return scopes
+
+    def _add_blob_from_file(self, args):
+        """
+        Add a file's contents to the object store
+        
+        @type   args: tuple
+        @param  args: A (key, (path, stat_result)) tuple
+        
+        @rtype  tuple
+        @return A (key, blob id) tuple
+        
+        """
+        
+        (key, (path, st)) = args
+        if stat.S_ISLNK(st.st_mode):
+            # A symlink is stored as a blob of its target
+            blob = dulwich.objects.Blob.from_string(os.readlink(path))
+            self.repo.object_store.add_object(blob)
+            return (key, blob.id)
+        
+        return (key, store_blob_file(self.repo.object_store.path, path, st.st_size))
+
+    def _get_stream_threshold(self):
+        """
+        Get the size from which files are streamed into the object store,
+        from core.bigfilethreshold if it is set
+        
+        """
+        
+        if not self.config.has("core", "bigfilethreshold"):
+            return STREAM_THRESHOLD
+        
+        value = self.config.get("core", "bigfilethreshold").strip().lower()
+        if value[-1:] in SIZE_UNITS:
+            return int(value[:-1]) * SIZE_UNITS[value[-1]]
+        return int(value)
+
+    def _read_blob_for_pack(self, args):
+        """
+        Read and compress a file's contents for a pack.  Large files are
+        left to be streamed into the pack.
+        
+        @type   args: tuple
+        @param  args: A (key, (path, stat_result), stream threshold) tuple.
+            Files of at least the threshold size are streamed.
+        
+        @rtype  tuple
+        @return A (key, blob id, data, compressed data) tuple.  Everything
+            but the key is None if the file should be streamed.
+        
+        """
+        
+        (key, (path, st), stream_threshold) = args
+        if stat.S_ISLNK(st.st_mode):
+            # A symlink is stored as a blob of its target
+            return (key,) + compress_blob(os.readlink(path))
+        
+        if st.st_size >= stream_threshold:
+            return (key, None, None, None)
+        
+        # No more than the threshold is read, in case the file has grown
+        file = open(path, "rb")
+        try:
+            data = file.read(stream_threshold)
+        finally:
+            file.close()
+        
+        if len(data) >= stream_threshold:
+            return (key, None, None, None)
+        
+        return (key,) + compress_blob(data)
+
+    def _add_blobs_to_pack(self, items, delta=False, stream_threshold=STREAM_THRESHOLD):
+        """
+        Write blobs into a single new pack.  Files are read and compressed
+        in parallel, and written to the pack in turn.  The pack only becomes
+        part of the object store once all of them have been written.
+        
+        @type   items: list
+        @param  items: (key, (path, stat_result)) tuples
+        
+        @type   delta: boolean
+        @param  delta: Store similar files as deltas of each other
+        
+        @type   stream_threshold: int
+        @param  stream_threshold: Files of at least this size are streamed
+            into the pack
+        
+        @rtype  dict
+        @return The blob id stored for each key
+        
+        """
+        
+        object_store = self.repo.object_store
+        writer = PackWriter(object_store.pack_dir, delta)
+        
+        paths = dict(items)
+        if delta:
+            # Files with the same name and similar sizes are most likely
+            # to be similar, so they are written next to each other
+            items = sorted(items, key=lambda (key, (path, st)): (os.path.basename(path), st.st_size))
+        
+        args = [(key, value, stream_threshold) for (key, value) in items]
+        if delta:
+            results = self._hasher.imap_ordered(self._read_blob_for_pack, args)
+        else:
+            results = self._hasher.imap_unordered(self._read_blob_for_pack, args)
+        
+        blob_ids = {}
+        try:
+            for (key, blob_id, data, compressed) in results:
+                if blob_id is None:
+                    (path, st) = paths[key]
+                    blob_id = writer.add_blob_file(path, st.st_size)
+                else:
+                    writer.add_blob(blob_id, data, compressed)
+                blob_ids[key] = blob_id
+            
+            basename = writer.finish()
+        except:
+            writer.abort()
+            raise
+        
+        if basename is not None:
+            object_store._add_known_pack(Pack(basename))
+        
+        return blob_ids
+
+    def _get_index_mtime(self):
+        """
+        Returns the modification time of the index file in whole seconds, or
+        0 if there is no index yet
+        
+        """
+        
+        # The index of a transaction will be written now, at the earliest
+        if self._transaction is not None:
+            return int(time())
+        
+        try:
+            return int(os.stat(self.repo.index_path()).st_mtime)
+        except OSError:
+            return 0
+
+    def _get_cache_time_seconds(self, cache_time):
+        # Index times are read back as (secs, nsecs) tuples, but are stored
+        # as plain ints or floats by stage() and checkout()
+        if isinstance(cache_time, tuple):
+            return cache_time[0]
+        return int(cache_time)
+
+    def _get_cache_mode(self, mode):
+        # Only the file type and the executable bit are significant to git
+        if stat.S_ISLNK(mode):
+            return 0120000
+        elif mode & 0100:
+            return 0100755
+        return 0100644
+
+    def _stat_matches_index_entry(self, entry, st, index_mtime):
+        """
+        Determine whether the stat data cached in an index entry still
+        describes the file on disk.  An entry whose mtime is not older than
+        the index file itself is "racily clean": the file may have changed in
+        the same second the index was written without its stat data changing,
+        so it is never trusted.
+        
+        @type   entry: tuple
+        @param  entry: An index entry
+        
+        @type   st: stat_result
+        @param  st: The result of os.lstat() on the working file
+        
+        @type   index_mtime: int
+        @param  index_mtime: The index file mtime, from _get_index_mtime()
+        
+        @rtype  boolean
         
         """
         
-        patterns = []
-        try:
-            git_dir = os.environ["GIT_DIR"]
-        except KeyError:
-            git_dir = self.repo.path
-
-        excludefile = os.path.join(git_dir, "info", "exclude")
-        if os.path.isfile(excludefile):
-            patterns += self._get_ignore_patterns_from_file(excludefile)
-
-        try:
-            core_excludesfile = self.config.get("core", "excludesfile")
-            if core_excludesfile:
-                patterns += self._get_ignore_patterns_from_file(core_excludesfile)
-        except KeyError:
-            pass
+        (ctime, mtime, dev, ino, mode, uid, gid, size, blob_id, flags) = entry
+        
+        mtime = self._get_cache_time_seconds(mtime)
+        if mtime >= index_mtime:
+            return False
+        
+        # The index only stores the low 32 bits of these fields
+        return (mtime == int(st.st_mtime)
+            and self._get_cache_time_seconds(ctime) == int(st.st_ctime)
+            and size == (st.st_size & 0xFFFFFFFF)
+            and ino == (st.st_ino & 0xFFFFFFFF)
+            and dev == (st.st_dev & 0xFFFFFFFF)
+            and self._get_cache_mode(mode) == self._get_cache_mode(st.st_mode))
 
-        return patterns
-    
-    def _get_ignore_patterns_from_file(self, path):
+    def _is_entry_staged(self, entry, tree_entry):
         """
-        Read in an ignore patterns file (i.e. .gitignore, $GIT_DIR/info/exclude)
-        and return a list of patterns
+        Determine whether an index entry differs from the HEAD entry for the
+        same path
+        
+        @type   entry: tuple
+        @param  entry: An index entry
+        
+        @type   tree_entry: tuple
+        @param  tree_entry: A (path, mode, sha) tuple from HEAD
+        
         """
         
-        patterns = []
-        if os.path.isfile(path):
-            file = open(path, "r")
-            try:
-                for line in file:
-                    if line == "" or line.startswith("#"):
-                        continue
+        return (entry[8] != tree_entry[2]
+            or self._get_cache_mode(entry[4]) != self._get_cache_mode(tree_entry[1]))
 
-                    patterns.append(line.rstrip("\n"))
-            finally:
-                file.close()
+    def _get_staged_set(self):
+        """
+        Get the set of staged paths, found with a single merge of HEAD and
+        the index.  The set is cached until HEAD or the index file changes.
+        
+        @rtype  set
         
-        return patterns
-
-    def _ignore_file(self, patterns, filename):
         """
-        Determine whether the given file should be ignored
+        
+        tree = self._get_tree_at_head()
+        try:
+            st = os.stat(self.repo.index_path())
+            index_key = (st.st_mtime, st.st_ctime, st.st_size, st.st_ino)
+        except OSError:
+            index_key = None
+        
+        # The index file doesn't change during a transaction, so it can't
+        # be used to tell whether the cached set is current
+        key = (tree.id, index_key)
+        if self._transaction is not None:
+            key = None
+        elif self._staged_cache is not None and self._staged_cache[0] == key:
+            return self._staged_cache[1]
+        
+        index = self._get_index()
+        staged = set()
+        merged = self._merge_status_streams(self._iter_tree_sorted(tree), sorted(index), [])
+        for (name, tree_entry, in_index, in_working) in merged:
+            if tree_entry is None or not in_index or self._is_entry_staged(index[name], tree_entry):
+                staged.add(name)
+        
+        self._staged_cache = (key, staged)
+        return staged
 
+    def _get_tracked_status(self, name, blob_id, tree_sha):
         """
-        for pattern in patterns:
-            if fnmatch.fnmatch(filename, pattern) and not pattern.startswith("!"):
-                return True
-
-        return False
-    
-    def _read_directory_tree(self, path, show_ignored_files=False):
-        files = []
-        directories = []
-        for root, dirs, filenames in os.walk(path, topdown=True):
-            try:
-                dirs.remove(".git")
-            except ValueError:
-                pass
-
-            # Generate a list of appropriate ignore patterns
-            patterns = []
-            if not show_ignored_files:
-                patterns = self.global_ignore_patterns
-
-                path_to_check = root
-                while path_to_check != self.repo.path:
-                    patterns += self._get_ignore_patterns_from_file(os.path.join(path_to_check, ".gitignore"))
-                    path_to_check = os.path.split(path_to_check)[0]
-                
-                patterns += self._get_ignore_patterns_from_file(os.path.join(root, ".gitignore"))
-
-            # Find the relative root path of this folder
-            if root == self.repo.path:
-                rel_root = ""
-            else:
-                rel_root = self.get_relative_path(root)
-                
-            for filename in filenames:
-                if not self._ignore_file(patterns, filename):
-                    files.append(os.path.join(rel_root, filename))
+        Get the status of a file that is both in HEAD and in the index
         
-            for _d in dirs:
-                if not self._ignore_file(patterns, _d):
-                    directories.append(os.path.join(rel_root, _d))
+        @type   blob_id: string
+        @param  blob_id: The blob id of the working file, or None if it
+            could not be read
         
-        directories.append("")
-        return (sorted(files), directories)
-
-    def _get_blob_from_file(self, path):
-        file = open(path, "rb")
-        try:
-            blob = dulwich.objects.Blob.from_string(file.read())
-        finally:
-            file.close()
+        """
         
-        return blob
+        if blob_id is None:
+            return MissingStatus(name)
+        elif blob_id == tree_sha:
+            return NormalStatus(name)
+        else:
+            return ModifiedStatus(name)
 
-    def _write_blob_to_file(self, path, blob):
+    def _write_blob_to_file(self, path, blob, mode=None):
         dirname = os.path.dirname(path)
         if not os.path.isdir(dirname):
             os.makedirs(dirname)
+        
+        # A symlink's blob holds its target
+        if mode is not None and stat.S_ISLNK(mode):
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(blob.data, path)
+            return
     
         file = open(path, "wb")
         try:
@@ -206,7 +1235,11 @@ class GittyupClient:
             file.close()
 
     def _load_config(self):
-        self.config = GittyupLocalFallbackConfig(self.repo.path)
+        if self.shared_state is None:
+            self.config = GittyupLocalFallbackConfig(self.repo.path)
+        else:
+            self.config = GittyupLocalFallbackConfig(self.repo.path,
+                self.shared_state.global_config, self.shared_state.system_config)
 
     def _get_config_user(self):
         try:
@@ -226,7 +1259,7 @@ class GittyupClient:
         fd.close()
     
     def _remove_from_index(self, index, key):
-        del index._byname[key]
+        del index[key]
     
     #
     # Start Public Methods
@@ -243,7 +1276,7 @@ class GittyupClient:
             self.repo = dulwich.repo.Repo.init(real_path)
             
         self._load_config()
-        self.global_ignore_patterns = self._get_global_ignore_patterns()
+        self._load_global_ignore_patterns()
 
         self.config.set_section("core", {
             "logallrefupdates": "true",
@@ -256,6 +1289,7 @@ class GittyupClient:
         try:
             self.repo = dulwich.repo.Repo(os.path.realpath(path))
             self._load_config()
+            self._load_global_ignore_patterns()
         except dulwich.errors.NotGitRepository:
             raise NotRepositoryError()
 
@@ -287,54 +1321,218 @@ class GittyupClient:
     def tracking(self):
         return self.repo.refs.read_ref("HEAD")[5:]
     
-    def stage(self, paths):
+    @contextmanager
+    def index_transaction(self):
+        """
+        Batch changes to the index.  The index is read once, index.lock is
+        held until the block ends, and stage(), unstage(), stage_all(),
+        unstage_all(), remove() and move() in the block all change the same
+        index in memory.  It is written once, when the block ends, or left
+        as it was if the block raises an exception.  Changes those methods
+        make to the working tree are not rolled back.
+        
+        Transactions may be nested, in which case the outermost one writes
+        the index.  commit() raises IndexTransactionError within a
+        transaction.
+        
+        """
+        
+        if self._transaction is not None:
+            yield
+            return
+        
+        fd = self._lock_index()
+        try:
+            index = self._get_index()
+        except:
+            self._unlock_index(fd)
+            raise
+        
+        transaction = _IndexTransaction(index, index.checksum)
+        self._transaction = transaction
+        try:
+            yield
+        except:
+            self._transaction = None
+            self._unlock_index(fd)
+            raise
+        
+        self._transaction = None
+        self._write_locked_index(fd, index, transaction.changed_paths)
+    
+    def stage(self, paths, use_pack=None, delta=False):
         """
-        Stage files to be committed or tracked
+        Stage files to be committed or tracked.  The index is locked while
+        the files are added to it, and written once, after every file has
+        been added.
         
         @type   paths: list
         @param  paths: A list of files
         
+        @type   use_pack: boolean
+        @param  use_pack: Write new content into a single pack file rather
+            than as loose objects.  By default a pack is used when there
+            are at least PACK_THRESHOLD new blobs.
+        
+        @type   delta: boolean
+        @param  delta: When writing a pack, store similar files as deltas
+            of each other
+        
+        @rtype  tuple
+        @return A (new, changed, unchanged) tuple of lists of
+            repository-relative paths.  new paths were not in the index
+            before, and unchanged paths were already staged with the same
+            content and mode.
+        
         """
 
-        index = self._get_index()
-
         if type(paths) in (str, unicode):
             paths = [paths]
 
-        for path in paths:
-            relative_path = self.get_relative_path(path)
-            absolute_path = self.get_absolute_path(path)
-            blob = self._get_blob_from_file(path)
+        # index.lock is held from the read to the write, so that a
+        # concurrent stage() fails instead of losing these entries
+        with self.index_transaction():
+            index = self._get_index()
             
-            if relative_path in index:
-                (ctime, mtime, dev, ino, mode, uid, gid, size, blob_id, flags) = index[relative_path]
-            else:
-                flags = 0
-
-            # make sure mtime and ctime is updated every time a file is staged
-            (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.stat(path)
-
-            index[relative_path] = (ctime, mtime, dev, ino, mode, uid, gid, size, blob.id, flags)
-            index.write()
-
-            self.repo.object_store.add_object(blob)
+            # Each file is stat()ed once, and the result is used both for
+            # hashing and for the index entry
+            files = [(path, os.lstat(path), None) for path in paths]
+            
+            result = self._stage_files(index, files, use_pack, delta)
+            (new, changed, unchanged) = result
+            self._write_index(index, new + changed)
+        
+        return result
     
-    def stage_all(self):
+    def stage_all(self, use_pack=None, delta=False):
         """
-        Stage all files in a repository to be committed or tracked
+        Stage all files in a repository to be committed or tracked.  The
+        blob ids worked out while classifying the files are reused, and the
+        index is written once.
+        
+        @type   use_pack: boolean
+        @param  use_pack: See stage()
+        
+        @type   delta: boolean
+        @param  delta: See stage()
         
         """
         
-        index = self._get_index()
-        for status in self.status():
+        snapshot = self._get_status_snapshot()
+        (tree, index, index_mtime, index_paths) = snapshot
+        
+        details = {}
+        files = []
+        removed = []
+        for status in self._iter_file_statuses([], [], snapshot, details=details):
             if status in [AddedStatus, RemovedStatus, ModifiedStatus]:
+                (file_stat, blob_id) = details.get(status.path, (None, None))
                 abs_path = self.get_absolute_path(status.path)
-                if os.path.isfile(abs_path):
-                    self.stage(abs_path)
+                if file_stat is None:
+                    try:
+                        file_stat = os.lstat(abs_path)
+                    except OSError:
+                        continue
+                
+                if not (stat.S_ISREG(file_stat.st_mode) or stat.S_ISLNK(file_stat.st_mode)):
+                    continue
+                
+                # Added files aren't hashed by status, but needn't be if
+                # they haven't changed since they were staged
+                if blob_id is None and status.path in index:
+                    if self._stat_matches_index_entry(index[status.path], file_stat, index_mtime):
+                        blob_id = index[status.path][8]
+                
+                files.append((abs_path, file_stat, blob_id))
 
-            if status == MissingStatus:
+            if status == MissingStatus and status.path in index:
                 self._remove_from_index(index, status.path)
-                index.write()           
+                removed.append(status.path)
+        
+        if files or removed:
+            (new, changed, unchanged) = self._stage_files(index, files, use_pack, delta)
+            self._write_index(index, new + changed + removed)
+
+    def _stage_files(self, index, files, use_pack=None, delta=False):
+        """
+        Add files to the in-memory index.  Files that haven't been hashed
+        are hashed in parallel, and content that isn't in the object store
+        yet is stored, also in parallel.
+        
+        @type   index: Index
+        @param  index: The index to update
+        
+        @type   files: list
+        @param  files: (absolute path, stat_result, blob id) tuples.  The
+            blob id is None if it isn't known yet.
+        
+        @type   use_pack: boolean
+        @param  use_pack: See stage()
+        
+        @type   delta: boolean
+        @param  delta: See stage()
+        
+        @rtype  tuple
+        @return See stage()
+        
+        """
+        
+        to_hash = [(path, st) for (path, st, blob_id) in files if blob_id is None]
+        hashed_blob_ids = dict(self._hasher.imap([path for (path, st) in to_hash], [st for (path, st) in to_hash]))
+        
+        # Blobs to add, by hashed blob id, or by path if the file could
+        # not be hashed
+        blob_keys = []
+        missing_blobs = {}
+        for (path, st, working_blob_id) in files:
+            if working_blob_id is None:
+                working_blob_id = hashed_blob_ids[path]
+            
+            key = working_blob_id
+            if key is None:
+                key = path
+            if key not in missing_blobs and (working_blob_id is None or working_blob_id not in self.repo.object_store):
+                missing_blobs[key] = (path, st)
+            blob_keys.append(key)
+        
+        # Then store the new content in parallel, once per distinct blob.
+        # The id of what was actually stored is used, in case a file changed
+        # after it was hashed.
+        if use_pack is None:
+            use_pack = (len(missing_blobs) >= PACK_THRESHOLD)
+        
+        new_blob_ids = {}
+        if use_pack and missing_blobs:
+            # Read once here rather than for every file on the worker threads
+            stream_threshold = self._get_stream_threshold()
+            new_blob_ids = self._add_blobs_to_pack(missing_blobs.items(), delta, stream_threshold)
+        else:
+            for (key, blob_id) in self._hasher.imap_unordered(self._add_blob_from_file, missing_blobs.items()):
+                new_blob_ids[key] = blob_id
+        
+        new = []
+        changed = []
+        unchanged = []
+        for ((path, st, blob_id), key) in zip(files, blob_keys):
+            relative_path = self.get_relative_path(path)
+            working_blob_id = new_blob_ids.get(key, key)
+            
+            if relative_path in index:
+                (ctime, mtime, dev, ino, mode, uid, gid, size, blob_id, flags) = index[relative_path]
+                if blob_id == working_blob_id and self._get_cache_mode(mode) == self._get_cache_mode(st.st_mode):
+                    unchanged.append(relative_path)
+                else:
+                    changed.append(relative_path)
+            else:
+                flags = 0
+                new.append(relative_path)
+
+            # make sure mtime and ctime is updated every time a file is staged
+            (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = st
+
+            index[relative_path] = (ctime, mtime, dev, ino, mode, uid, gid, size, working_blob_id, flags)
+        
+        return (new, changed, unchanged)
 
     def unstage(self, paths):
         """
@@ -351,18 +1549,28 @@ class GittyupClient:
         if type(paths) in (str, unicode):
             paths = [paths]
 
+        # Hash the files that are both staged and in HEAD up front
+        changed_paths = []
+        to_hash = []
+        for path in paths:
+            relative_path = self.get_relative_path(path)
+            if relative_path in index and relative_path in tree:
+                to_hash.append(path)
+        working_blob_ids = dict(self._hasher.imap(to_hash))
+
         for path in paths:
             relative_path = self.get_relative_path(path)
+            changed_paths.append(relative_path)
             if relative_path in index:
                 if relative_path in tree:
                     (ctime, mtime, dev, ino, mode, uid, gid, size, blob_id, flags) = index[relative_path]
                     (mode, blob_id) = tree[relative_path]
                     
-                    # If the file is locally modified, set these vars to 0
-                    # I'm not sure yet why this needs to happen, but it does
-                    # in order for the file to appear modified and not normal
-                    blob = self._get_blob_from_file(path)
-                    if blob.id != blob_id:
+                    # If the file is locally modified, set these vars to 0.
+                    # The stat data describes the working file, which no
+                    # longer matches the blob from HEAD, so status() must not
+                    # trust it
+                    if working_blob_ids[path] != blob_id:
                         ctime = 0
                         mtime = 0
                         dev = 0
@@ -378,22 +1586,38 @@ class GittyupClient:
                 if relative_path in tree:
                     index[relative_path] = (0, 0, 0, 0, tree[relative_path][0], 0, 0, 0, tree[relative_path][1], 0)
 
-        index.write()
+        self._write_index(index, changed_paths)
             
     def unstage_all(self):
         """
-        Unstage all files so they are not committed or tracked
-        
-        @type   paths: list
-        @param  paths: A list of files
+        Unstage all files so they are not committed or tracked.  HEAD and
+        the index are walked together once, every entry is reset to HEAD
+        without hashing any files, and the index is written once.
         
         """
         
         index = self._get_index()
-        for status in self.status():
-            abs_path = self.get_absolute_path(status.path)
-            if os.path.isfile(abs_path):
-                self.unstage(abs_path)
+        tree = self._get_tree_at_head()
+        
+        changed = []
+        merged = self._merge_status_streams(self._iter_tree_sorted(tree), sorted(index), [])
+        for (name, tree_entry, in_index, working_entry) in merged:
+            if tree_entry is None:
+                self._remove_from_index(index, name)
+            elif not in_index:
+                index[name] = (0, 0, 0, 0, tree_entry[1], 0, 0, 0, tree_entry[2], 0)
+            elif self._is_entry_staged(index[name], tree_entry):
+                # The stat data describes the staged content rather than
+                # HEAD's, so status() must not trust it
+                flags = index[name][9]
+                index[name] = (0, 0, 0, 0, tree_entry[1], 0, 0, 0, tree_entry[2], flags)
+            else:
+                continue
+            
+            changed.append(name)
+        
+        if changed:
+            self._write_index(index, changed)
     
     def get_staged(self):
         """
@@ -401,23 +1625,7 @@ class GittyupClient:
         
         """
 
-        staged = []
-        tree = self._get_tree_at_head()
-        index = self._get_index()
-
-        if len(tree) > 0:
-            for item in index.changes_from_tree(self.repo.object_store, tree.id):
-                ((old_name, new_name), (old_mode, new_mode), (old_sha, new_sha)) = item
-
-                if new_name:
-                    staged.append(new_name)
-                if old_name and old_name != new_name:
-                    staged.append(old_name)
-        else:
-            for path in index:
-                staged.append(path)
-
-        return staged
+        return sorted(self._get_staged_set())
 
     def is_staged(self, path, staged_files=None):
         """
@@ -426,12 +1634,17 @@ class GittyupClient:
         @type   path: string
         @param  path: A file path
         
+        @type   staged_files: list
+        @param  staged_files: The staged files, from get_staged().  Defaults
+            to a set of staged files that is cached until HEAD or the index
+            changes.
+        
         @rtype  boolean
         
         """
         
-        if not staged_files:
-            staged_files = self.get_staged()
+        if staged_files is None:
+            staged_files = self._get_staged_set()
         
         relative_path = self.get_relative_path(path)
         return (relative_path in staged_files)
@@ -563,9 +1776,9 @@ class GittyupClient:
             if name in relative_paths or len(paths) == 0:
                 blob = self.repo[sha]
                 absolute_path = self.get_absolute_path(name)
-                self._write_blob_to_file(absolute_path, blob)                
+                self._write_blob_to_file(absolute_path, blob, mode)
 
-                (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.stat(absolute_path)
+                (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.lstat(absolute_path)
                 index[name] = (ctime, mtime, dev, ino, mode, uid, gid, size, blob.id, 0)
     
     def clone(self, host, path, bare=False, origin="origin"):
@@ -638,14 +1851,20 @@ class GittyupClient:
         @type   commit_all: boolean
         @param  commit_all: Stage all changed files before committing
         
+        A commit can't be made within an index_transaction(), since moving
+        HEAD couldn't be undone if the transaction were rolled back.
+        
         """
 
+        if self._transaction is not None:
+            raise IndexTransactionError("Can't commit within an index transaction")
+
         if commit_all:
             self.stage_all()
 
         commit = dulwich.objects.Commit()
         commit.message = message
-        commit.tree = commit_index(self.repo.object_store, self._get_index())
+        commit.tree = self._commit_index()
 
         initial_commit = False
         try:
@@ -683,7 +1902,9 @@ class GittyupClient:
     
     def remove(self, paths):
         """
-        Remove path from the repository.  Also deletes the local file.
+        Remove path from the repository.  Also deletes the local file.  A
+        directory's tracked files are removed, along with any directories
+        that are left empty.
         
         @type   paths: list
         @param  paths: A list of paths to remove
@@ -695,13 +1916,26 @@ class GittyupClient:
 
         index = self._get_index()
         
+        removed = []
         for path in paths:
-            relative_path = self.get_relative_path(path)
-            if relative_path in index:
-                self._remove_from_index(index, relative_path)
-                os.remove(path)
+            names = index.remove_path(self.get_relative_path(path))
+            for name in names:
+                try:
+                    os.remove(self.get_absolute_path(name))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            
+            if names and os.path.isdir(path):
+                for (dirpath, dirnames, filenames) in os.walk(path, topdown=False):
+                    try:
+                        os.rmdir(dirpath)
+                    except OSError:
+                        pass
+            
+            removed += names
 
-        index.write()        
+        self._write_index(index, removed)
     
     def move(self, source, dest):
         """
@@ -720,26 +1954,15 @@ class GittyupClient:
         index = self._get_index()
         relative_source = self.get_relative_path(source)
         relative_dest = self.get_relative_path(dest)
+        if os.path.isdir(dest):
+            relative_dest = os.path.join(relative_dest, os.path.basename(relative_source))
 
-        # Get a list of affected files so we can update the index
-        source_files = []
-        if os.path.isdir(source):
-            for name in index:
-                if name.startswith(relative_source):
-                    source_files.append(name)
-        else:
-            source_files.append(self.get_relative_path(source))
-
-        # Rename the affected index entries
-        for source_file in source_files:
-            new_path = source_file.replace(relative_source, relative_dest)            
-            if os.path.isdir(dest):
-                new_path = os.path.join(new_path, os.path.basename(source_file))
-
-            index[new_path] = index[source_file]
-            self._remove_from_index(index, source_file)
+        # The source and everything below it are renamed together
+        changed_paths = []
+        for (old_name, new_name) in index.rename_path(relative_source, relative_dest):
+            changed_paths += [old_name, new_name]
 
-        index.write()
+        self._write_index(index, changed_paths)
         
         # Actually move the file/folder
         shutil.move(source, dest)
@@ -940,105 +2163,296 @@ class GittyupClient:
         
         return tags
     
-    def status(self, paths_to_return=[]):
+    def status(self, paths_to_return=[], show_ignored=False, collapse_untracked=False):
         """
         Generates a list of GittyupStatus objects for all files in the 
             repository.
         
+        @type   paths_to_return: list
+        @param  paths_to_return: Files or directories to limit the status to.
+            Only these parts of the repository are read.  Defaults to the
+            whole repository.
+        
+        @type   show_ignored: boolean
+        @param  show_ignored: Also return an IgnoredStatus for each ignored
+            file and directory that isn't tracked.  An ignored directory is
+            a single entry, and its contents are not read.
+        
+        @type   collapse_untracked: boolean
+        @param  collapse_untracked: Return a single UntrackedStatus for a
+            directory with nothing in the index below it, instead of one for
+            each file in it, like "git status -unormal".  Such directories
+            are only read far enough to find one file.
+        
         """
 
         if type(paths_to_return) in (str, unicode):
             paths_to_return = [paths_to_return]
-    
-        tree = self._get_tree_at_head()
-        tree_index = self._get_tree_index(tree)
-        index = self._get_index()
-        (files, directories) = self._read_directory_tree(self.repo.path)
-
-        statuses = []
-        tracked_paths = set(index)
-        if len(tree_index) > 0:
-            for (name, mode, sha) in self.repo.object_store.iter_tree_contents(tree.id):
-                if name in tracked_paths:
-                    if name in tree_index:
-                        absolute_path = self.get_absolute_path(name)
-                        if os.path.exists(absolute_path):
-                            # Cached, determine if modified or not                        
-                            blob = self._get_blob_from_file(absolute_path)
-                            if blob.id == tree_index[name][1]:
-                                statuses.append(NormalStatus(name))
-                            else:
-                                statuses.append(ModifiedStatus(name))
-                        else:
-                            # Missing
-                            statuses.append(MissingStatus(name))
-                    else:
-                        statuses.append(AddedStatus(name))
-                        
-                    tracked_paths.remove(name)
-                else:
-                    # Removed
-                    statuses.append(RemovedStatus(name))
 
-                try:
-                    files.remove(name)
-                except ValueError:
-                    pass
-
-        for name in tracked_paths:
-            # Added
-            statuses.append(AddedStatus(name))
-            try:
-                files.remove(name)
-            except ValueError:
-                pass
-
-        # Find untracked files
-        for f in files:
-            statuses.append(UntrackedStatus(f))
-
-        # If path is specified as a parameter, narrow the list down
+        # HEAD entries come first, then added, untracked and ignored files
         final_statuses = []
-        if len(paths_to_return) > 0:
-            for path_to_return in paths_to_return:
-                if path_to_return and self.get_absolute_path(path_to_return) != self.repo.path:
-                    relative_path = self.get_relative_path(path_to_return)
-                    if os.path.isdir(path_to_return):
-                        for st in statuses:
-                            if st.path.startswith(relative_path) or relative_path == "":
-                                final_statuses.append(st)
-                    elif os.path.isfile(path_to_return):
-                        for st in statuses:
-                            if st.path == relative_path:
-                                final_statuses.append(st)
-                                break
-                else:
-                    final_statuses = statuses
-                    break
-        else:
-            final_statuses = statuses
-            
-        del statuses
+        added_statuses = []
+        untracked_statuses = []
+        ignored_statuses = []
+        directories = []
+        for st in self._iter_file_statuses(paths_to_return, directories, None, show_ignored, collapse_untracked):
+            if st.identifier == "added":
+                added_statuses.append(st)
+            elif st.identifier == "untracked":
+                untracked_statuses.append(st)
+            elif st.identifier == "ignored":
+                ignored_statuses.append(st)
+            else:
+                final_statuses.append(st)
+        
+        # Hashed files are yielded out of order
+        final_statuses.sort(key=lambda st: st.path)
+        final_statuses += added_statuses + untracked_statuses + ignored_statuses
 
         # Determine status of folders based on child contents
-        for d in directories:
-            d_status = NormalStatus(d)
-            for st in final_statuses:
-                if os.path.join(d, os.path.basename(st.path)) == st.path:
+        final_statuses += self.get_directory_statuses(final_statuses, directories)
 
-                    if st.identifier != "normal" and st.identifier != "untracked":
-                        d_status = ModifiedStatus(d)
-            
+        return final_statuses
+
+    def iter_status(self, paths_to_return=[], show_ignored=False, collapse_untracked=False):
+        """
+        Generates GittyupStatus objects for all files in the repository as
+            soon as each file has been classified, with is_staged already
+            set.  Files that have to be hashed are yielded once their hash
+            is ready, so files are not yielded in a fixed order.  Directory
+            statuses are yielded last.
+        
+        @type   paths_to_return: list
+        @param  paths_to_return: Files or directories to limit the status to.
+            Defaults to the whole repository.
+        
+        @type   show_ignored: boolean
+        @param  show_ignored: See status()
+        
+        @type   collapse_untracked: boolean
+        @param  collapse_untracked: See status()
+        
+        @rtype  generator
+        
+        """
+
+        if type(paths_to_return) in (str, unicode):
+            paths_to_return = [paths_to_return]
+        
+        # Directory statuses only depend on the changed files
+        changed_statuses = []
+        directories = []
+        for st in self._iter_file_statuses(paths_to_return, directories, None, show_ignored, collapse_untracked):
+            if st.identifier not in ("normal", "untracked", "ignored"):
+                changed_statuses.append(st)
+            yield st
+        
+        for st in self.get_directory_statuses(changed_statuses, directories):
+            yield st
 
-            final_statuses.append(d_status)
+    def _get_status_snapshot(self):
+        """
+        Read the state of HEAD and the index that status is computed against
+        
+        @rtype  tuple
+        @return A (tree, index, index_mtime, sorted index paths) tuple
+        
+        """
+        
+        tree = self._get_tree_at_head()
+        index = self._get_index()
+        index_mtime = self._get_index_mtime()
+        return (tree, index, index_mtime, sorted(index))
 
-        # Calculate which files are staged
-        staged_files = self.get_staged()
-        for index,st in enumerate(final_statuses):
-            final_statuses[index].is_staged = (st.path in staged_files)
+    def _iter_file_statuses(self, paths_to_return, directories, snapshot=None, show_ignored=False, collapse_untracked=False, details=None):
+        """
+        Yield a GittyupStatus object, with is_staged set, for each file as
+        soon as it is classified.  Files whose stat data doesn't match the
+        index are hashed in the background and yielded when they are done.
+        
+        @type   paths_to_return: list
+        @param  paths_to_return: See status()
+        
+        @type   directories: list
+        @param  directories: The directories that are walked are appended
+            to this list
+        
+        @type   snapshot: tuple
+        @param  snapshot: A tuple from _get_status_snapshot() to reuse
+            instead of reading HEAD and the index again
+        
+        @type   show_ignored: boolean
+        @param  show_ignored: See status()
+        
+        @type   collapse_untracked: boolean
+        @param  collapse_untracked: See status()
+        
+        @type   details: dict
+        @param  details: If given, it maps the path of each file that was
+            looked at to a (stat_result, blob id) tuple, so that the work
+            isn't repeated.  Either may be None if it wasn't needed.
+        
+        """
+        
+        if snapshot is None:
+            snapshot = self._get_status_snapshot()
+        (tree, index, index_mtime, index_paths) = snapshot
 
-        return final_statuses
+        # Each scope is a disjoint subtree with its own merge, so only the
+        # requested parts of the working tree, HEAD and index are read
+        scopes = self._get_status_scopes(paths_to_return)
+        if scopes is None:
+            scopes = [""]
+        
+        # (name, HEAD sha, is_staged, result) of files being hashed
+        pending = deque()
+        max_pending = self._hasher.workers * 4
+        
+        collapse_index_paths = None
+        if collapse_untracked:
+            collapse_index_paths = index_paths
+        
+        for scope in scopes:
+            ignored = None
+            if show_ignored:
+                ignored = []
+            
+            merged = self._merge_status_streams(
+                self._iter_tree_sorted_at(tree, scope),
+                gittyup.util.get_path_range(index_paths, scope),
+                self._iter_working_tree(scope, directories, False, ignored, collapse_index_paths)
+            )
+            
+            for (name, tree_entry, in_index, working_entry) in merged:
+                st = None
+                if tree_entry is not None:
+                    if in_index:
+                        entry = index[name]
+                        is_staged = self._is_entry_staged(entry, tree_entry)
+                        
+                        # Reuse the walk's stat data.  Ignored files aren't
+                        # walked, so they are stat()ed here.
+                        absolute_path = self.get_absolute_path(name)
+                        file_stat = None
+                        if working_entry is not None:
+                            file_stat = working_entry[1]
+                        if file_stat is None:
+                            try:
+                                file_stat = os.lstat(absolute_path)
+                            except OSError:
+                                pass
+                        
+                        if file_stat is None or stat.S_ISDIR(file_stat.st_mode):
+                            # Missing
+                            st = MissingStatus(name)
+                        elif self._stat_matches_index_entry(entry, file_stat, index_mtime):
+                            st = self._get_tracked_status(name, entry[8], tree_entry[2])
+                            if details is not None:
+                                details[name] = (file_stat, entry[8])
+                        elif not (stat.S_ISREG(file_stat.st_mode) or stat.S_ISLNK(file_stat.st_mode)):
+                            # Replaced by something that can't be hashed
+                            st = ModifiedStatus(name)
+                        else:
+                            result = self._hasher.hash_async(absolute_path, file_stat)
+                            pending.append((name, tree_entry[2], is_staged, result))
+                            if details is not None:
+                                details[name] = (file_stat, None)
+                    else:
+                        # Removed
+                        st = RemovedStatus(name)
+                        is_staged = True
+                elif in_index:
+                    # Added
+                    st = AddedStatus(name)
+                    is_staged = True
+                else:
+                    # Untracked
+                    st = UntrackedStatus(name)
+                    is_staged = False
+                
+                if details is not None and working_entry is not None and name not in details:
+                    details[name] = (working_entry[1], None)
+                
+                if st is not None:
+                    st.is_staged = is_staged
+                    yield st
+                
+                # Yield the hashed files that are done, and wait for the
+                # oldest one if too many are in flight
+                while pending and (pending[0][3].ready() or len(pending) > max_pending):
+                    yield self._get_hashed_status(pending.popleft(), details)
+            
+            # The walk skipped these without looking inside.  Tracked files
+            # stay tracked even if they match a pattern, and a directory
+            # holding any is not wholly ignored.
+            if ignored:
+                for (path, is_dir) in ignored:
+                    if not gittyup.util.get_path_range(index_paths, path):
+                        yield IgnoredStatus(path)
+        
+        while pending:
+            yield self._get_hashed_status(pending.popleft(), details)
+
+    def _get_hashed_status(self, pending, details=None):
+        (name, tree_sha, is_staged, result) = pending
+        (path, blob_id) = result.get()
+        
+        if details is not None:
+            details[name] = (details[name][0], blob_id)
+        
+        st = self._get_tracked_status(name, blob_id, tree_sha)
+        st.is_staged = is_staged
+        return st
     
+    def get_directory_statuses(self, statuses, directories=None):
+        """
+        Determines the status of directories from the statuses of the files
+        they contain, in a single pass.  A directory is modified if any file
+        below it, at any depth, is not normal, untracked or ignored.
+        
+        @type   statuses: list
+        @param  statuses: GittyupStatus objects, as returned by status()
+        
+        @type   directories: list
+        @param  directories: Repository-relative directories to report on.
+            Defaults to every directory containing one of the given paths.
+        
+        @rtype  list
+        @return A list of NormalStatus and ModifiedStatus objects
+        
+        """
+        
+        # Each directory is visited at most once, because propagation stops
+        # at the first ancestor that has already been seen
+        modified = set()
+        seen = set()
+        for st in statuses:
+            if st.identifier in ("normal", "untracked", "ignored"):
+                if directories is not None:
+                    continue
+                ancestors = seen
+            else:
+                ancestors = modified
+            
+            d = os.path.dirname(st.path)
+            while d not in ancestors:
+                ancestors.add(d)
+                if d == "":
+                    break
+                d = os.path.dirname(d)
+        
+        if directories is None:
+            directories = sorted(seen | modified)
+        
+        d_statuses = []
+        for d in directories:
+            if d in modified:
+                d_statuses.append(ModifiedStatus(d))
+            else:
+                d_statuses.append(NormalStatus(d))
+        
+        return d_statuses
+
     def log(self, refspec="HEAD", limit=None):
         """
         Returns a revision history list
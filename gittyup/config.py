@@ -203,7 +203,7 @@ class GittyupFallbackConfig:
         raise NotImplementedError()
 
 class GittyupLocalFallbackConfig(GittyupFallbackConfig):
-    def __init__(self, repository_path):
+    def __init__(self, repository_path, global_config=None, system_config=None):
         """
         Provides transparent access to the local, global, and system-level
         git config files.
@@ -211,10 +211,22 @@ class GittyupLocalFallbackConfig(GittyupFallbackConfig):
         @type   repository_path string
         @param  repository_path The root folder of a git repository
         
+        @type   global_config   GittyupGlobalConfig
+        @param  global_config   An already parsed global config file to use
+        
+        @type   system_config   GittyupSystemConfig
+        @param  system_config   An already parsed system config file to use
+        
         """
         self._local = GittyupLocalConfig(repository_path)
-        self._global = GittyupGlobalConfig()
-        self._system = GittyupSystemConfig()
+        
+        if global_config is None:
+            global_config = GittyupGlobalConfig()
+        if system_config is None:
+            system_config = GittyupSystemConfig()
+        
+        self._global = global_config
+        self._system = system_config
         self._must_write_to_system = False
 
     def _config(self, section, key=None):
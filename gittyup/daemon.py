@@ -0,0 +1,362 @@
+#
+# daemon.py
+#
+
+import os
+import errno
+import select
+import socket
+
+from gittyup.client import GittyupClient
+from gittyup.watcher import GittyupWatcher
+from gittyup.exceptions import *
+from gittyup.objects import *
+
+SOCKET_NAME = "gittyup.sock"
+RECEIVE_SIZE = 65536
+
+# How long the daemon waits on a client that stops reading or writing
+CONNECTION_TIMEOUT = 5
+
+STATUS_CLASSES = {}
+for status_class in (NormalStatus, AddedStatus, RenamedStatus, RemovedStatus,
+        ModifiedStatus, KilledStatus, UntrackedStatus, MissingStatus, IgnoredStatus):
+    STATUS_CLASSES[status_class.identifier] = status_class
+
+def get_socket_path(path):
+    """
+    Get the path of the socket a repository's daemon listens on
+
+    @type   path: string
+    @param  path: The root folder of a git repository
+
+    """
+
+    return os.path.join(os.path.realpath(path), ".git", SOCKET_NAME)
+
+def encode_message(fields):
+    """
+    Encode a message as a field count followed by the fields.  Each is
+    terminated by a NUL, which can't appear in a path.
+
+    """
+
+    return "%d\0%s" % (len(fields), "".join([field + "\0" for field in fields]))
+
+class _Connection:
+    """
+    Reads and writes whole messages on a socket
+
+    """
+
+    def __init__(self, sock):
+        self.socket = sock
+        self._buffer = ""
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def _parse_message(self):
+        end = self._buffer.find("\0")
+        if end < 0:
+            return None
+
+        count = int(self._buffer[:end])
+        fields = []
+        start = end + 1
+        for i in range(count):
+            end = self._buffer.find("\0", start)
+            if end < 0:
+                return None
+            fields.append(self._buffer[start:end])
+            start = end + 1
+
+        self._buffer = self._buffer[start:]
+        return fields
+
+    def receive(self):
+        """
+        Read whatever has arrived
+
+        @rtype  boolean
+        @return False if the other end has closed the connection
+
+        """
+
+        data = self.socket.recv(RECEIVE_SIZE)
+        self._buffer += data
+        return (data != "")
+
+    def read_message(self):
+        """
+        Return the next complete message that has been received, or None
+
+        """
+
+        return self._parse_message()
+
+    def wait_for_message(self):
+        """
+        Block until a complete message has been received
+
+        """
+
+        while True:
+            message = self._parse_message()
+            if message is not None:
+                return message
+
+            if not self.receive():
+                raise GittyupDaemonError("The connection was closed")
+
+    def send_message(self, fields):
+        self.socket.sendall(encode_message(fields))
+
+    def close(self):
+        self.socket.close()
+
+class GittyupDaemon:
+    def __init__(self, path, socket_path=None):
+        """
+        Keeps the status of a working copy in memory and answers status
+        queries from other processes over a Unix socket.  The status is kept
+        up to date by a GittyupWatcher, so a query never rescans the working
+        tree.
+
+        @type   path: string
+        @param  path: The root folder of a git repository
+
+        @type   socket_path: string
+        @param  socket_path: Where to listen.  Defaults to gittyup.sock in
+            the repository's .git directory.
+
+        """
+
+        self.client = GittyupClient(path)
+        self.watcher = GittyupWatcher(self.client)
+
+        if socket_path is None:
+            socket_path = get_socket_path(path)
+        self.socket_path = socket_path
+
+        self._socket = None
+        self._connections = []
+
+    #
+    # Start Private Methods
+    #
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            # Only replace the socket of a daemon that is no longer running
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                try:
+                    probe.connect(self.socket_path)
+                    raise GittyupDaemonError("A daemon is already listening on %s" % self.socket_path)
+                except socket.error:
+                    os.remove(self.socket_path)
+            finally:
+                probe.close()
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # Only the owner of the repository may ask about it
+        old_umask = os.umask(0077)
+        try:
+            self._socket.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+
+        self._socket.listen(16)
+
+    def _accept(self):
+        (sock, address) = self._socket.accept()
+        sock.settimeout(CONNECTION_TIMEOUT)
+        self._connections.append(_Connection(sock))
+
+    def _close_connection(self, connection):
+        self._connections.remove(connection)
+        connection.close()
+
+    def _handle(self, connection):
+        try:
+            if not connection.receive():
+                self._close_connection(connection)
+                return
+
+            while True:
+                message = connection.read_message()
+                if message is None:
+                    break
+
+                connection.send_message(self._answer(message))
+        except (socket.error, ValueError):
+            self._close_connection(connection)
+
+    def _answer(self, message):
+        """
+        Answer a query.  The reply starts with "ok" or "error".
+
+        """
+
+        # Apply any changes that have happened since the last query
+        self.watcher.process_events()
+
+        if not message:
+            return ["error", "Empty query"]
+
+        query = message[0]
+        args = message[1:]
+        try:
+            if query == "status":
+                statuses = self.watcher.get_statuses(self.client._get_status_scopes(args))
+                reply = ["ok"]
+                for st in statuses:
+                    reply += [st.identifier, st.is_staged and "1" or "0", st.path]
+                return reply
+            elif query == "is_staged" and len(args) == 1:
+                st = self.watcher.get_status(self.client.get_relative_path(args[0]))
+                return ["ok", (st is not None and st.is_staged) and "1" or "0"]
+            elif query == "tracking":
+                return ["ok", self.client.tracking()]
+            elif query == "ping":
+                return ["ok"]
+            else:
+                return ["error", "Unknown query %s" % query]
+        except Exception, e:
+            return ["error", str(e)]
+
+    #
+    # Start Public Methods
+    #
+
+    def start(self):
+        """
+        Take the baseline status and start listening
+
+        """
+
+        self.watcher.start()
+        self._listen()
+
+    def stop(self):
+        """
+        Stop listening and watching the working copy
+
+        """
+
+        for connection in list(self._connections):
+            self._close_connection(connection)
+
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+        self.watcher.stop()
+
+    def process(self, timeout=None):
+        """
+        Answer pending queries and apply changes to the working copy
+
+        @type   timeout: float
+        @param  timeout: How long to wait for something to happen, in
+            seconds.  None waits indefinitely.
+
+        """
+
+        readers = [self.watcher, self._socket] + self._connections
+        try:
+            ready = select.select(readers, [], [], timeout)[0]
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return
+            raise
+
+        for reader in ready:
+            if reader is self.watcher:
+                self.watcher.process_events()
+            elif reader is self._socket:
+                self._accept()
+            else:
+                self._handle(reader)
+
+    def run(self):
+        """
+        Serve queries until stop() is called
+
+        """
+
+        while self._socket is not None:
+            self.process()
+
+class GittyupDaemonClient:
+    def __init__(self, path, socket_path=None):
+        """
+        Asks a repository's GittyupDaemon about its status.  The methods
+        match those of GittyupClient.
+
+        @type   path: string
+        @param  path: The root folder of a git repository
+
+        @type   socket_path: string
+        @param  socket_path: Where the daemon listens.  Defaults to
+            gittyup.sock in the repository's .git directory.
+
+        """
+
+        if socket_path is None:
+            socket_path = get_socket_path(path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except socket.error, e:
+            sock.close()
+            raise GittyupDaemonError("No daemon is listening on %s: %s" % (socket_path, e))
+
+        self._connection = _Connection(sock)
+
+    def _query(self, fields):
+        try:
+            self._connection.send_message(fields)
+            reply = self._connection.wait_for_message()
+        except socket.error, e:
+            raise GittyupDaemonError(str(e))
+
+        if not reply or reply[0] != "ok":
+            raise GittyupDaemonError(len(reply) > 1 and reply[1] or "Bad reply")
+
+        return reply[1:]
+
+    def status(self, paths_to_return=[]):
+        """
+        Get the status of the working copy, like GittyupClient.status()
+
+        """
+
+        if type(paths_to_return) in (str, unicode):
+            paths_to_return = [paths_to_return]
+
+        reply = self._query(["status"] + [os.path.abspath(path) for path in paths_to_return])
+
+        statuses = []
+        for i in range(0, len(reply), 3):
+            st = STATUS_CLASSES[reply[i]](reply[i + 2])
+            st.is_staged = (reply[i + 1] == "1")
+            statuses.append(st)
+
+        return statuses
+
+    def is_staged(self, path):
+        return (self._query(["is_staged", os.path.abspath(path)])[0] == "1")
+
+    def tracking(self):
+        return self._query(["tracking"])[0]
+
+    def close(self):
+        self._connection.close()
@@ -32,8 +32,32 @@ class NotTagError(Exception):
     def __init__(self, *args, **kwargs):
         Exception.__init__(self, *args, **kwargs)
 
+class IndexLockedError(Exception):
+    """Indicates the index is locked by another process"""
+
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+class IndexTransactionError(Exception):
+    """Indicates an operation can't be done within an index transaction"""
+
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
 class GittyupCommandError(Exception):
     """Indicates a command returned an error"""
 
     def __init__(self, *args, **kwargs):
         Exception.__init__(self, *args, **kwargs)
+
+class GittyupWatcherError(Exception):
+    """Indicates that the working tree could not be watched for changes"""
+
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+class GittyupDaemonError(Exception):
+    """Indicates that a status daemon could not be reached or failed"""
+
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
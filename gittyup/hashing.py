@@ -0,0 +1,419 @@
+#
+# hashing.py
+#
+
+import os
+import stat
+import zlib
+import errno
+import hashlib
+import tempfile
+import threading
+from itertools import imap
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+HASH_CHUNK_SIZE = 65536
+
+# Thread pools by (process id, number of workers).  Every BlobHasher with the
+# same number of workers shares one, so creating clients doesn't create
+# threads.  A forked child doesn't have its parent's threads, so it gets its
+# own pools.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(workers):
+    _pools_lock.acquire()
+    try:
+        key = (os.getpid(), workers)
+        if key not in _pools:
+            _pools[key] = ThreadPool(workers)
+        return _pools[key]
+    finally:
+        _pools_lock.release()
+
+def close_pools():
+    """
+    Stop the threads of the shared hashing pools and wait for them to
+    finish.  Pools are created again when they are next needed.
+
+    """
+
+    _pools_lock.acquire()
+    try:
+        pools = [pool for ((pid, workers), pool) in _pools.items() if pid == os.getpid()]
+        _pools.clear()
+    finally:
+        _pools_lock.release()
+
+    for pool in pools:
+        pool.close()
+        pool.join()
+
+def hash_blob_data(data):
+    """
+    Compute the git blob id of a string
+
+    """
+
+    sha = hashlib.sha1("blob %d\0" % len(data))
+    sha.update(data)
+    return sha.hexdigest()
+
+def copy_to_temp_file(file, dir=None, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Copy the rest of a file to a temporary file a chunk at a time, so that
+    contents that keep changing can be read again at a size that doesn't.
+    The copy is deleted when it is closed.
+
+    @type   dir: string
+    @param  dir: Where to create the copy.  Defaults to the system's
+        temporary directory.
+
+    @rtype  tuple
+    @return A (copy, size) tuple.  The copy is open for reading from the
+        start.
+
+    """
+
+    copy = tempfile.TemporaryFile(dir=dir)
+    try:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            copy.write(chunk)
+
+        size = copy.tell()
+        copy.seek(0)
+    except:
+        copy.close()
+        raise
+
+    return (copy, size)
+
+def _hash_blob_chunks(file, size, chunk_size):
+    """
+    Hash a blob as it is read from a file
+
+    @rtype  tuple
+    @return A (hex sha, length read) tuple
+
+    """
+
+    sha = hashlib.sha1("blob %d\0" % size)
+    length = 0
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        sha.update(chunk)
+        length += len(chunk)
+
+    return (sha.hexdigest(), length)
+
+def hash_blob_file(path, chunk_size=HASH_CHUNK_SIZE, size=None):
+    """
+    Compute the git blob id of a file's contents without reading the whole
+    file into memory.  The "blob <length>" header is hashed first, then the
+    contents in chunks.
+
+    @type   path: string
+    @param  path: The file to hash
+
+    @type   chunk_size: int
+    @param  chunk_size: How much to read at a time
+
+    @type   size: int
+    @param  size: The file size, if it is already known from a stat call
+
+    @rtype  string
+    @return The hex sha of the blob
+
+    """
+
+    file = open(path, "rb")
+    try:
+        for attempt in range(3):
+            if size is None:
+                size = os.fstat(file.fileno()).st_size
+            (sha, length) = _hash_blob_chunks(file, size, chunk_size)
+            if length == size:
+                return sha
+
+            # The file changed size while it was being read, start over
+            file.seek(0)
+            size = None
+
+        # The file keeps changing, so hash a copy of whatever it contains
+        # now
+        (copy, size) = copy_to_temp_file(file, chunk_size=chunk_size)
+        try:
+            return _hash_blob_chunks(copy, size, chunk_size)[0]
+        finally:
+            copy.close()
+    finally:
+        file.close()
+
+def _write_loose_blob(file, tmp_file, size, chunk_size):
+    """
+    Compress a blob into a loose object file as it is hashed
+
+    @rtype  tuple
+    @return A (blob id, length read) tuple
+
+    """
+
+    sha = hashlib.sha1("blob %d\0" % size)
+    compressor = zlib.compressobj()
+    tmp_file.write(compressor.compress("blob %d\0" % size))
+    length = 0
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        sha.update(chunk)
+        tmp_file.write(compressor.compress(chunk))
+        length += len(chunk)
+
+    tmp_file.write(compressor.flush())
+    return (sha.hexdigest(), length)
+
+def store_blob_file(objects_dir, path, size=None, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Add a file's contents to an object store as a loose blob without
+    reading the whole file into memory.  The object is compressed into a
+    temporary file as the file is read and hashed, and is then renamed into
+    place.
+
+    @type   objects_dir: string
+    @param  objects_dir: The object store's objects directory
+
+    @type   path: string
+    @param  path: The file to store
+
+    @type   size: int
+    @param  size: The file size, if it is already known from a stat call
+
+    @rtype  string
+    @return The blob id
+
+    """
+
+    file = open(path, "rb")
+    try:
+        (fd, tmp_path) = tempfile.mkstemp(dir=objects_dir, prefix="tmp_obj_")
+        try:
+            tmp_file = os.fdopen(fd, "wb")
+            try:
+                for attempt in range(3):
+                    if size is None:
+                        size = os.fstat(file.fileno()).st_size
+                    (blob_id, length) = _write_loose_blob(file, tmp_file, size, chunk_size)
+                    if length == size:
+                        break
+
+                    # The file changed size while it was being read, start
+                    # over
+                    file.seek(0)
+                    tmp_file.seek(0)
+                    tmp_file.truncate()
+                    size = None
+                else:
+                    # The file keeps changing, so store whatever it
+                    # contains now, from a copy that can't change
+                    (copy, size) = copy_to_temp_file(file, objects_dir, chunk_size)
+                    try:
+                        (blob_id, length) = _write_loose_blob(copy, tmp_file, size, chunk_size)
+                    finally:
+                        copy.close()
+            finally:
+                tmp_file.close()
+
+            object_dir = os.path.join(objects_dir, blob_id[:2])
+            object_path = os.path.join(object_dir, blob_id[2:])
+            if os.path.exists(object_path):
+                os.remove(tmp_path)
+                return blob_id
+
+            try:
+                os.mkdir(object_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            # Objects are read only, as in git
+            os.chmod(tmp_path, 0444)
+            os.rename(tmp_path, object_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    finally:
+        file.close()
+
+    return blob_id
+
+def hash_blob_path(path, st=None):
+    """
+    Compute the git blob id of a working tree path: the contents of a
+    regular file, or the target of a symlink
+
+    @type   path: string
+    @param  path: The path to hash
+
+    @type   st: stat_result
+    @param  st: The path's lstat() result, if it is already known
+
+    @rtype  string
+    @return The hex sha of the blob
+
+    """
+
+    if st is None:
+        st = os.lstat(path)
+
+    if stat.S_ISLNK(st.st_mode):
+        return hash_blob_data(os.readlink(path))
+    elif not stat.S_ISREG(st.st_mode):
+        # Opening a fifo or device could block or never end
+        raise IOError(errno.EINVAL, "Not a regular file", path)
+
+    return hash_blob_file(path, size=st.st_size)
+
+def _hash_blob_path_or_none(args):
+    (path, st) = args
+    try:
+        return (path, hash_blob_path(path, st))
+    except (OSError, IOError):
+        return (path, None)
+
+class _FinishedResult:
+    """
+    Stands in for an AsyncResult when hashing without a thread pool
+
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+class BlobHasher:
+    def __init__(self, workers=None):
+        """
+        Hashes working tree files on a bounded pool of threads.  hashlib
+        and file reads release the GIL, so the threads hash in parallel.
+        The pool is shared with other BlobHashers that have the same number
+        of workers.
+
+        @type   workers: int
+        @param  workers: The number of hashing threads.  Defaults to the
+            number of CPUs.
+
+        """
+
+        if workers is None:
+            try:
+                workers = cpu_count()
+            except NotImplementedError:
+                workers = 1
+
+        self.workers = workers
+
+    def hash(self, path, st=None):
+        """
+        Hash a single file or symlink in the calling thread
+
+        """
+
+        return hash_blob_path(path, st)
+
+    def hash_async(self, path, st=None):
+        """
+        Start hashing a file in the background
+
+        @type   path: string
+        @param  path: An absolute file path
+
+        @type   st: stat_result
+        @param  st: The path's lstat() result, if it is already known
+
+        @rtype  AsyncResult
+        @return An object whose ready() method says whether the hash is done
+            and whose get() method waits for and returns a (path, sha)
+            tuple.  sha is None if the file could not be read.
+
+        """
+
+        # A symlink's target is cheaper to hash than to hand to a thread
+        if self.workers <= 1 or (st is not None and stat.S_ISLNK(st.st_mode)):
+            return _FinishedResult(_hash_blob_path_or_none((path, st)))
+
+        return _get_pool(self.workers).apply_async(_hash_blob_path_or_none, ((path, st),))
+
+    def imap(self, paths, stats=None):
+        """
+        Hash a list of files
+
+        @type   paths: list
+        @param  paths: A list of absolute file paths
+
+        @type   stats: list
+        @param  stats: The lstat() results of the paths, if they are
+            already known
+
+        @rtype  iterator
+        @return (path, sha) tuples in the same order as paths.  sha is None
+            if the file could not be read.
+
+        """
+
+        if stats is None:
+            stats = [None] * len(paths)
+        args = zip(paths, stats)
+
+        if self.workers <= 1 or len(paths) <= 1:
+            return imap(_hash_blob_path_or_none, args)
+
+        return _get_pool(self.workers).imap(_hash_blob_path_or_none, args, 16)
+
+    def imap_unordered(self, function, items):
+        """
+        Call a function on each item on the hashing threads, for other work
+        that is mostly I/O and compression
+
+        @rtype  iterator
+        @return The results, in the order they finish
+
+        """
+
+        if self.workers <= 1 or len(items) <= 1:
+            return imap(function, items)
+
+        return _get_pool(self.workers).imap_unordered(function, items)
+
+    def imap_ordered(self, function, items):
+        """
+        Like imap_unordered(), but the results come back in the order of
+        items
+
+        """
+
+        if self.workers <= 1 or len(items) <= 1:
+            return imap(function, items)
+
+        return _get_pool(self.workers).imap(function, items)
+
+    def close(self):
+        """
+        Stop the hashing threads and wait for them to finish.  They are
+        shared, so this affects every BlobHasher.
+
+        """
+
+        close_pools()
@@ -0,0 +1,296 @@
+#
+# ignore.py
+#
+
+import os
+import re
+
+# Python's re module can't compile more than 100 groups in one expression
+REGEX_CHUNK_SIZE = 90
+
+GLOB_CHARACTERS = "*?[\\"
+
+def parse_ignore_pattern(line):
+    """
+    Parse a single line of a gitignore file
+
+    @type   line: string
+    @param  line: A line from a gitignore file
+
+    @rtype  tuple or None
+    @return A (glob, negated, dir_only, anchored) tuple, or None if the line
+        is blank or a comment
+
+    """
+
+    line = line.rstrip("\r\n")
+
+    # Trailing spaces are ignored unless they are escaped
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "
+    line = stripped
+
+    if line == "" or line.startswith("#"):
+        return None
+
+    negated = False
+    if line.startswith("!"):
+        negated = True
+        line = line[1:]
+    elif line.startswith("\\!") or line.startswith("\\#"):
+        line = line[1:]
+
+    dir_only = False
+    if line.endswith("/") and not line.endswith("\\/"):
+        dir_only = True
+        line = line.rstrip("/")
+
+    # A slash anywhere but at the end ties the pattern to the directory of
+    # the file it was read from
+    anchored = ("/" in line)
+    line = line.lstrip("/")
+
+    if line == "":
+        return None
+
+    return (line, negated, dir_only, anchored)
+
+def read_ignore_patterns(path):
+    """
+    Read the patterns in an ignore file, skipping blank lines and comments.
+    A missing file has no patterns.
+
+    @type   path: string
+    @param  path: An ignore file (i.e. .gitignore, $GIT_DIR/info/exclude)
+
+    @rtype  list
+
+    """
+
+    patterns = []
+    if os.path.isfile(path):
+        file = open(path, "r")
+        try:
+            for line in file:
+                if line.strip() == "" or line.startswith("#"):
+                    continue
+
+                patterns.append(line.rstrip("\n"))
+        finally:
+            file.close()
+
+    return patterns
+
+def translate_glob(glob):
+    """
+    Translate a gitignore glob into a regular expression.  Wildcards never
+    match a "/", except for "**" as a whole path component.  The expression
+    contains no capturing groups.
+
+    """
+
+    i = 0
+    n = len(glob)
+    res = []
+    while i < n:
+        c = glob[i]
+        if glob.startswith("**/", i) and (i == 0 or glob[i-1] == "/"):
+            res.append("(?:.*/)?")
+            i += 3
+        elif glob.startswith("**", i) and i + 2 == n and (i == 0 or glob[i-1] == "/"):
+            res.append(".*")
+            i += 2
+        elif c == "*":
+            while i < n and glob[i] == "*":
+                i += 1
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+            i += 1
+        elif c == "[":
+            j = i + 1
+            if j < n and glob[j] in "!^":
+                j += 1
+            if j < n and glob[j] == "]":
+                j += 1
+            while j < n and glob[j] != "]":
+                j += 1
+            if j >= n:
+                res.append("\\[")
+                i += 1
+            else:
+                content = glob[i+1:j].replace("\\", "\\\\")
+                if content[0] in "!^":
+                    content = "^" + content[1:]
+                res.append("(?!/)[%s]" % content)
+                i = j + 1
+        elif c == "\\" and i + 1 < n:
+            res.append(re.escape(glob[i+1]))
+            i += 2
+        else:
+            res.append(re.escape(c))
+            i += 1
+
+    return "".join(res)
+
+def _is_literal(glob):
+    for c in GLOB_CHARACTERS:
+        if c in glob:
+            return False
+    return True
+
+class _IgnoreTable:
+    """
+    Lookup structures for the patterns that apply to one kind of path (files
+    or directories).  Every structure maps back to pattern indexes so the
+    last matching pattern can be found.
+
+    """
+
+    def __init__(self):
+        self.name_literals = {}
+        self.path_literals = {}
+        self.name_suffixes = {}
+        self.suffix_lengths = []
+        self.name_regexes = []
+        self.path_regexes = []
+
+    def add(self, index, glob, anchored):
+        if anchored:
+            if _is_literal(glob):
+                self.path_literals[glob] = index
+            else:
+                self.path_regexes.append((index, translate_glob(glob)))
+        else:
+            if _is_literal(glob):
+                self.name_literals[glob] = index
+            elif glob.startswith("*") and _is_literal(glob[1:]):
+                suffix = glob[1:]
+                self.name_suffixes[suffix] = index
+                if len(suffix) not in self.suffix_lengths:
+                    self.suffix_lengths.append(len(suffix))
+            else:
+                self.name_regexes.append((index, translate_glob(glob)))
+
+    def compile(self):
+        self.name_regexes = self._compile_chunks(self.name_regexes)
+        self.path_regexes = self._compile_chunks(self.path_regexes)
+
+    def _compile_chunks(self, regexes):
+        """
+        Combine the regexes into as few expressions as possible.  Each chunk
+        lists its patterns last-first, so the group that matches is the last
+        pattern in the chunk that applies.  The chunks themselves are
+        returned last-first as (highest index, regex, indexes) tuples.
+
+        """
+
+        chunks = []
+        for start in range(0, len(regexes), REGEX_CHUNK_SIZE):
+            chunk = regexes[start:start + REGEX_CHUNK_SIZE]
+            chunk.reverse()
+            regex = re.compile("(?:%s)\\Z" % "|".join(["(%s)" % r for (i, r) in chunk]))
+            chunks.insert(0, (chunk[0][0], regex, [i for (i, r) in chunk]))
+
+        return chunks
+
+    def find(self, name, path):
+        """
+        Returns the index of the last pattern that matches, or -1
+
+        """
+
+        best = max(self.name_literals.get(name, -1), self.path_literals.get(path, -1))
+
+        for length in self.suffix_lengths:
+            if length <= len(name):
+                best = max(best, self.name_suffixes.get(name[len(name)-length:], -1))
+
+        best = self._find_regex(self.name_regexes, name, best)
+        best = self._find_regex(self.path_regexes, path, best)
+
+        return best
+
+    def _find_regex(self, chunks, value, best):
+        for (highest, regex, indexes) in chunks:
+            if highest <= best:
+                break
+
+            m = regex.match(value)
+            if m:
+                return max(best, indexes[m.lastindex - 1])
+
+        return best
+
+class IgnoreMatcher:
+    def __init__(self, patterns, base=""):
+        """
+        Compiles a list of gitignore patterns so that paths can be matched
+        against all of them at once.  Literal names and "*suffix" patterns
+        are looked up in hash tables, and the remaining patterns are combined
+        into a few regular expressions.
+
+        @type   patterns: list
+        @param  patterns: Lines from a gitignore file, in file order
+
+        @type   base: string
+        @param  base: The repository-relative directory the patterns were
+            read from.  Anchored patterns are matched relative to it.
+
+        """
+
+        self.base = base
+        self.negated = []
+
+        # One table for files, one for directories
+        self._tables = (_IgnoreTable(), _IgnoreTable())
+
+        for line in patterns:
+            parsed = parse_ignore_pattern(line)
+            if parsed is None:
+                continue
+
+            (glob, negated, dir_only, anchored) = parsed
+            index = len(self.negated)
+            self.negated.append(negated)
+
+            if not dir_only:
+                self._tables[0].add(index, glob, anchored)
+            self._tables[1].add(index, glob, anchored)
+
+        for table in self._tables:
+            table.compile()
+
+    def __len__(self):
+        return len(self.negated)
+
+    def match(self, path, is_dir=False):
+        """
+        Match a path against the patterns.  As in git, the last matching
+        pattern decides.
+
+        @type   path: string
+        @param  path: A repository-relative path
+
+        @type   is_dir: boolean
+        @param  is_dir: Whether the path is a directory
+
+        @rtype  boolean or None
+        @return True if the path is ignored, False if a negated pattern
+            re-includes it, or None if no pattern matches
+
+        """
+
+        if self.base:
+            if not path.startswith(self.base + "/"):
+                return None
+            relative_path = path[len(self.base) + 1:]
+        else:
+            relative_path = path
+
+        index = self._tables[is_dir and 1 or 0].find(os.path.basename(path), relative_path)
+        if index < 0:
+            return None
+
+        return (not self.negated[index])
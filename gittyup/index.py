@@ -0,0 +1,411 @@
+#
+# index.py
+#
+
+import os
+import struct
+import hashlib
+import binascii
+from bisect import bisect_left
+from time import time
+from cStringIO import StringIO
+
+from dulwich.errors import ChecksumMismatch
+from dulwich.index import Index, read_cache_entry, write_cache_entry, write_index_dict
+from dulwich.pack import SHA1Writer
+
+from gittyup.util import get_path_bounds
+
+SHARED_INDEX_PREFIX = "sharedindex."
+
+# As in git, a shared index that no index has used for this long is deleted
+SHARED_INDEX_EXPIRE_SECONDS = 14 * 24 * 60 * 60
+
+# The default for splitindex.maxpercentchange, as in git
+SPLIT_INDEX_MAX_PERCENT_CHANGE = 20
+
+def ewah_decode(data, offset=0):
+    """
+    Decode an EWAH compressed bitmap, as used by git
+
+    @type   data: string
+    @param  data: The data the bitmap is in
+
+    @type   offset: int
+    @param  offset: Where the bitmap starts
+
+    @rtype  tuple
+    @return A (positions, offset) tuple.  positions is a sorted list of the
+        set bits, and offset is where the bitmap ends.
+
+    """
+
+    (bit_count, word_count) = struct.unpack(">LL", data[offset:offset + 8])
+    offset += 8
+    words = struct.unpack(">%dQ" % word_count, data[offset:offset + word_count * 8])
+    # The words are followed by the position of the last marker word
+    offset += word_count * 8 + 4
+
+    positions = []
+    bit = 0
+    i = 0
+    while i < word_count:
+        marker = words[i]
+        run_length = (marker >> 1) & 0xffffffff
+        literal_count = marker >> 33
+        if marker & 1:
+            positions.extend(range(bit, min(bit + run_length * 64, bit_count)))
+        bit += run_length * 64
+
+        for word in words[i + 1:i + 1 + literal_count]:
+            while word:
+                low_bit = word & -word
+                positions.append(bit + low_bit.bit_length() - 1)
+                word ^= low_bit
+            bit += 64
+
+        i += 1 + literal_count
+
+    return (positions, offset)
+
+def ewah_encode(positions):
+    """
+    Encode a sorted list of set bits as an EWAH compressed bitmap.  Only
+    runs of clear words are compressed, which is all an index needs.
+
+    @rtype  string
+
+    """
+
+    literals = {}
+    for position in positions:
+        literals[position // 64] = literals.get(position // 64, 0) | (1 << (position % 64))
+
+    # Each marker word is [clear words before it, literal words after it]
+    markers = [[0, []]]
+    next_word = 0
+    for word_index in sorted(literals):
+        if word_index > next_word:
+            if markers[-1][1]:
+                markers.append([0, []])
+            markers[-1][0] = word_index - next_word
+        markers[-1][1].append(literals[word_index])
+        next_word = word_index + 1
+
+    words = []
+    last_marker = 0
+    for (run_length, marker_literals) in markers:
+        last_marker = len(words)
+        words.append((run_length << 1) | (len(marker_literals) << 33))
+        words.extend(marker_literals)
+
+    bit_count = 0
+    if positions:
+        bit_count = positions[-1] + 1
+
+    return (struct.pack(">LL", bit_count, len(words))
+        + struct.pack(">%dQ" % len(words), *words)
+        + struct.pack(">L", last_marker))
+
+def read_index_data(path):
+    """
+    Read and check an index file
+
+    @rtype  tuple
+    @return An (entries, extensions, checksum) tuple.  entries is a list of
+        (name, ctime, mtime, dev, ino, mode, uid, gid, size, sha, flags)
+        tuples, in the order they are in the file, and extensions is a
+        dict of the extension data by signature.
+
+    """
+
+    file = open(path, "rb")
+    try:
+        data = file.read()
+    finally:
+        file.close()
+
+    checksum = data[-20:]
+    actual = hashlib.sha1(data[:-20]).digest()
+    if actual != checksum:
+        raise ChecksumMismatch(checksum, actual)
+
+    header = data[:4]
+    if header != "DIRC":
+        raise AssertionError("Invalid index file header: %r" % header)
+    (version, num_entries) = struct.unpack(">LL", data[4:12])
+    assert version in (1, 2)
+
+    f = StringIO(data)
+    f.seek(12)
+    entries = [read_cache_entry(f) for i in xrange(num_entries)]
+
+    extensions = {}
+    offset = f.tell()
+    while offset < len(data) - 20:
+        (signature, size) = struct.unpack(">4sL", data[offset:offset + 8])
+        extensions[signature] = data[offset + 8:offset + 8 + size]
+        offset += 8 + size
+
+    return (entries, extensions, checksum)
+
+class GittyupIndex(Index):
+    def __init__(self, filename):
+        """
+        An index that can also be read and written in git's split index
+        format, where the index file only holds the entries that differ from
+        a shared index file.  Writing a change then costs a write of the
+        differences instead of the whole index.
+
+        @type   filename: string
+        @param  filename: The index file
+
+        """
+
+        self.control_dir = os.path.dirname(filename)
+
+        # The checksum at the end of the index file when it was read, or
+        # None if there was no index file
+        self.checksum = None
+
+        # The shared index the entries were read from, if any
+        self.shared_sha = None
+        self.shared_names = []
+        self.shared_entries = {}
+
+        # The entry names in order, kept until an entry is added or removed
+        self._sorted_names = None
+
+        Index.__init__(self, filename)
+
+    def read(self):
+        if not os.path.exists(self._filename):
+            return
+
+        (entries, extensions, checksum) = read_index_data(self._filename)
+        self.checksum = checksum
+        link = extensions.get("link")
+        if link is None:
+            for entry in entries:
+                self._byname[entry[0]] = entry[1:]
+
+            # The entries are stored in order.  If a path has several
+            # conflict stages, only one of them is kept.
+            if len(entries) == len(self._byname):
+                self._sorted_names = [entry[0] for entry in entries]
+            return
+
+        shared_sha = link[:20]
+        deleted = []
+        replaced = []
+        if len(link) > 20:
+            (deleted, offset) = ewah_decode(link, 20)
+            (replaced, offset) = ewah_decode(link, offset)
+
+        shared_path = self.get_shared_index_path(shared_sha)
+        (shared_entries, shared_extensions, shared_checksum) = read_index_data(shared_path)
+        if shared_checksum != shared_sha:
+            raise ChecksumMismatch(shared_sha, shared_checksum)
+
+        self.shared_sha = shared_sha
+        self.shared_names = [entry[0] for entry in shared_entries]
+        for entry in shared_entries:
+            self.shared_entries[entry[0]] = entry[1:]
+        self._byname = self.shared_entries.copy()
+
+        for position in deleted:
+            del self._byname[self.shared_names[position]]
+
+        # Replacements come first, nameless and in the order of the bitmap,
+        # and are followed by added entries
+        for (position, entry) in zip(replaced, entries):
+            self._byname[self.shared_names[position]] = entry[1:]
+        for entry in entries[len(replaced):]:
+            self._byname[entry[0]] = entry[1:]
+
+    def clear(self):
+        Index.clear(self)
+        self._sorted_names = None
+
+    def __setitem__(self, name, x):
+        if name not in self._byname:
+            self._sorted_names = None
+        Index.__setitem__(self, name, x)
+
+    def __delitem__(self, name):
+        Index.__delitem__(self, name)
+        self._sorted_names = None
+
+    def get_sorted_names(self):
+        """
+        Get the entry names in order.  The list is shared and must not be
+        changed.
+
+        """
+
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self._byname)
+
+        return self._sorted_names
+
+    def remove_path(self, path):
+        """
+        Remove the entry for a path, or the entries below it if it is a
+        directory
+
+        @rtype  list
+        @return The names of the removed entries
+
+        """
+
+        names = self.get_sorted_names()
+        (exact, start, end) = get_path_bounds(names, path)
+        removed = names[start:end]
+        del names[start:end]
+        if exact is not None:
+            removed.insert(0, path)
+            del names[exact]
+
+        for name in removed:
+            del self._byname[name]
+
+        return removed
+
+    def rename_path(self, source, dest):
+        """
+        Rename the entry for a path, or the entries below it if it is a
+        directory.  Existing entries for the new names are replaced.
+
+        @rtype  list
+        @return (old name, new name) tuples
+
+        """
+
+        names = self.get_sorted_names()
+        (exact, start, end) = get_path_bounds(names, source)
+        moved = names[start:end]
+        if exact is not None:
+            moved.insert(0, source)
+        if not moved:
+            return []
+
+        renamed = [dest + name[len(source):] for name in moved]
+        entries = [self._byname.pop(name) for name in moved]
+
+        del names[start:end]
+        if exact is not None:
+            del names[exact]
+
+        replaced = False
+        for (name, entry) in zip(renamed, entries):
+            if name in self._byname:
+                replaced = True
+            self._byname[name] = entry
+
+        # The new names are in order, so they can be spliced in as a block
+        # unless other names sort between them
+        position = bisect_left(names, renamed[0])
+        if replaced or (position < len(names) and names[position] < renamed[-1]):
+            self._sorted_names = None
+        else:
+            names[position:position] = renamed
+
+        return zip(moved, renamed)
+
+    def get_shared_index_path(self, shared_sha):
+        return os.path.join(self.control_dir, SHARED_INDEX_PREFIX + binascii.hexlify(shared_sha))
+
+    def get_split_changes(self):
+        """
+        Compare the entries with the shared index
+
+        @rtype  tuple or None
+        @return A (deleted, replaced, added) tuple of the positions of the
+            shared entries that were removed, the positions of those that
+            were changed, and the names of new entries.  None if the index
+            wasn't read from a shared index.
+
+        """
+
+        if self.shared_sha is None:
+            return None
+
+        deleted = []
+        replaced = []
+        for (position, name) in enumerate(self.shared_names):
+            entry = self._byname.get(name)
+            if entry is None:
+                deleted.append(position)
+            elif entry != self.shared_entries[name]:
+                replaced.append(position)
+
+        added = [name for name in self._byname if name not in self.shared_entries]
+        added.sort()
+
+        return (deleted, replaced, added)
+
+    def write_shared_index(self):
+        """
+        Write all the entries to a new shared index, which later split
+        writes are made against.  Shared indexes that have expired are
+        deleted.
+
+        """
+
+        tmp_path = os.path.join(self.control_dir, "%stmp.%d" % (SHARED_INDEX_PREFIX, os.getpid()))
+        f = SHA1Writer(open(tmp_path, "wb"))
+        try:
+            write_index_dict(f, self._byname)
+            shared_sha = f.write_sha()
+        finally:
+            f.f.close()
+
+        os.rename(tmp_path, self.get_shared_index_path(shared_sha))
+
+        self.shared_sha = shared_sha
+        self.shared_names = sorted(self._byname)
+        self.shared_entries = self._byname.copy()
+
+        self.expire_shared_indexes()
+
+    def expire_shared_indexes(self):
+        expire_time = time() - SHARED_INDEX_EXPIRE_SECONDS
+        current = os.path.basename(self.get_shared_index_path(self.shared_sha))
+        for name in os.listdir(self.control_dir):
+            if not name.startswith(SHARED_INDEX_PREFIX) or name == current:
+                continue
+
+            path = os.path.join(self.control_dir, name)
+            try:
+                if os.stat(path).st_mtime < expire_time:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def write_split_index(self, f, changes):
+        """
+        Write the entries that differ from the shared index, followed by the
+        link extension that names it
+
+        @type   f: SHA1Writer
+        @param  f: Where to write the index
+
+        @type   changes: tuple
+        @param  changes: As returned by get_split_changes()
+
+        """
+
+        (deleted, replaced, added) = changes
+
+        # Mark the shared index as still in use
+        os.utime(self.get_shared_index_path(self.shared_sha), None)
+
+        f.write("DIRC")
+        f.write(struct.pack(">LL", 2, len(replaced) + len(added)))
+        for position in replaced:
+            write_cache_entry(f, ("",) + self._byname[self.shared_names[position]])
+        for name in added:
+            write_cache_entry(f, (name,) + self._byname[name])
+
+        link = self.shared_sha + ewah_encode(deleted) + ewah_encode(replaced)
+        f.write("link" + struct.pack(">L", len(link)) + link)
@@ -0,0 +1,452 @@
+#
+# pack.py
+#
+
+import os
+import zlib
+import struct
+import hashlib
+import binascii
+import tempfile
+
+from gittyup.hashing import hash_blob_data, copy_to_temp_file
+
+PACK_VERSION = 2
+PACK_INDEX_VERSION = 2
+
+OBJ_BLOB = 3
+OBJ_OFS_DELTA = 6
+
+STREAM_CHUNK_SIZE = 65536
+
+# How many earlier blobs are tried as delta bases, and the largest blob
+# that is deltified.  The delta search is done in Python, so it is kept to
+# small files.
+DELTA_WINDOW = 8
+DELTA_MAX_SIZE = 65536
+DELTA_BLOCK_SIZE = 16
+
+# The longest chain of deltas a blob can be rebuilt from, as in git
+DELTA_MAX_DEPTH = 50
+
+# The largest copy a single delta instruction is given, as in git
+DELTA_MAX_COPY = 0x10000
+DELTA_MAX_INSERT = 0x7f
+
+def encode_entry_header(type_num, size):
+    """
+    Encode the type and inflated size that start each pack entry
+
+    """
+
+    c = (type_num << 4) | (size & 0x0f)
+    size >>= 4
+    header = []
+    while size:
+        header.append(chr(c | 0x80))
+        c = size & 0x7f
+        size >>= 7
+    header.append(chr(c))
+    return "".join(header)
+
+def encode_delta_offset(offset):
+    """
+    Encode the distance back to the base of an OFS_DELTA entry
+
+    """
+
+    encoded = [chr(offset & 0x7f)]
+    offset >>= 7
+    while offset:
+        offset -= 1
+        encoded.insert(0, chr(0x80 | (offset & 0x7f)))
+        offset >>= 7
+    return "".join(encoded)
+
+def _encode_delta_size(size):
+    encoded = []
+    while True:
+        c = size & 0x7f
+        size >>= 7
+        if size:
+            encoded.append(chr(c | 0x80))
+        else:
+            encoded.append(chr(c))
+            return "".join(encoded)
+
+def _encode_copy(offset, length):
+    op = 0x80
+    args = []
+    for i in range(4):
+        byte = (offset >> (i * 8)) & 0xff
+        if byte:
+            op |= 1 << i
+            args.append(chr(byte))
+    for i in range(3):
+        byte = (length >> (i * 8)) & 0xff
+        if byte:
+            op |= 1 << (4 + i)
+            args.append(chr(byte))
+    return chr(op) + "".join(args)
+
+def create_delta(base, target, max_size=None):
+    """
+    Create a git delta that rebuilds target from base.  Blocks of the base
+    are indexed, and the target is scanned for them; matches are extended
+    forwards and everything else is inserted literally.
+
+    @type   max_size: int
+    @param  max_size: Give up once the delta is this large
+
+    @rtype  string or None
+    @return The delta, or None if it would be larger than max_size
+
+    """
+
+    blocks = {}
+    for i in range(0, len(base) - DELTA_BLOCK_SIZE + 1, DELTA_BLOCK_SIZE):
+        blocks.setdefault(base[i:i + DELTA_BLOCK_SIZE], i)
+
+    out = [_encode_delta_size(len(base)), _encode_delta_size(len(target))]
+    out_size = len(out[0]) + len(out[1])
+    insert_start = 0
+    i = 0
+    end = len(target)
+    while i < end:
+        j = blocks.get(target[i:i + DELTA_BLOCK_SIZE])
+        if j is None:
+            i += 1
+            if max_size is not None and out_size + i - insert_start > max_size:
+                return None
+            continue
+
+        # Extend the match, a chunk at a time while that's possible
+        length = DELTA_BLOCK_SIZE
+        while (j + length + 64 <= len(base) and i + length + 64 <= end
+                and base[j + length:j + length + 64] == target[i + length:i + length + 64]):
+            length += 64
+        while j + length < len(base) and i + length < end and base[j + length] == target[i + length]:
+            length += 1
+
+        for start in range(insert_start, i, DELTA_MAX_INSERT):
+            chunk = target[start:min(start + DELTA_MAX_INSERT, i)]
+            out.append(chr(len(chunk)) + chunk)
+            out_size += len(chunk) + 1
+
+        for start in range(0, length, DELTA_MAX_COPY):
+            copy_length = min(DELTA_MAX_COPY, length - start)
+            op = _encode_copy(j + start, copy_length)
+            out.append(op)
+            out_size += len(op)
+
+        i += length
+        insert_start = i
+        if max_size is not None and out_size > max_size:
+            return None
+
+    for start in range(insert_start, end, DELTA_MAX_INSERT):
+        chunk = target[start:min(start + DELTA_MAX_INSERT, end)]
+        out.append(chr(len(chunk)) + chunk)
+        out_size += len(chunk) + 1
+
+    if max_size is not None and out_size > max_size:
+        return None
+
+    return "".join(out)
+
+def compress_blob(data):
+    """
+    Compress blob data for a pack entry.  zlib releases the GIL, so this
+    can be run on several threads.
+
+    @rtype  tuple
+    @return A (blob id, data, compressed data) tuple
+
+    """
+
+    return (hash_blob_data(data), data, zlib.compress(data))
+
+class PackWriter:
+    def __init__(self, pack_dir, delta=False):
+        """
+        Writes blobs into a new pack file, with its version 2 index.  The
+        pack is written to a temporary file and only appears in the object
+        store, under its final name, when finish() is called.
+
+        @type   pack_dir: string
+        @param  pack_dir: The object store's pack directory
+
+        @type   delta: boolean
+        @param  delta: Store small blobs as deltas against similar blobs
+            written shortly before them, when that is much smaller
+
+        """
+
+        self.pack_dir = pack_dir
+        self.delta = delta
+
+        if not os.path.isdir(pack_dir):
+            os.makedirs(pack_dir)
+
+        (fd, self._path) = tempfile.mkstemp(dir=pack_dir, prefix="tmp_pack_")
+        self._file = os.fdopen(fd, "w+b")
+        self._offset = 0
+
+        # (binary sha, offset, crc32) of each entry
+        self._entries = []
+        self._shas = set()
+
+        # (offset, data, delta depth) of recent blobs that deltas can be
+        # made against
+        self._window = []
+
+        # The object count is filled in by finish()
+        self._write(struct.pack(">4sLL", "PACK", PACK_VERSION, 0))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _write(self, data):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def _add_entry(self, sha, offset, crc):
+        self._entries.append((binascii.unhexlify(sha), offset, crc & 0xffffffff))
+        self._shas.add(sha)
+
+    def _find_delta(self, data):
+        """
+        Find the smallest delta for data against the window
+
+        @rtype  tuple or None
+        @return A (base offset, delta, depth) tuple
+
+        """
+
+        best = None
+        max_size = len(data) / 2
+        for (base_offset, base, depth) in self._window:
+            # Blobs of very different sizes are unlikely to be similar
+            if len(base) > len(data) * 2 or len(data) > len(base) * 2:
+                continue
+            if depth >= DELTA_MAX_DEPTH:
+                continue
+
+            delta = create_delta(base, data, max_size)
+            if delta is not None:
+                best = (base_offset, delta, depth + 1)
+                max_size = len(delta) - 1
+
+        return best
+
+    def add_blob(self, sha, data, compressed=None):
+        """
+        Write a blob that is already in memory
+
+        @type   sha: string
+        @param  sha: The blob id
+
+        @type   compressed: string
+        @param  compressed: data compressed with zlib, if that has already
+            been done
+
+        """
+
+        if sha in self._shas:
+            return
+
+        offset = self._offset
+        found = None
+        depth = 0
+        if self.delta and len(data) <= DELTA_MAX_SIZE:
+            found = self._find_delta(data)
+
+        if found is None:
+            if compressed is None:
+                compressed = zlib.compress(data)
+            header = encode_entry_header(OBJ_BLOB, len(data))
+            crc = binascii.crc32(header)
+        else:
+            (base_offset, delta, depth) = found
+            compressed = zlib.compress(delta)
+            header = encode_entry_header(OBJ_OFS_DELTA, len(delta)) + encode_delta_offset(offset - base_offset)
+            crc = binascii.crc32(header)
+
+        self._write(header)
+        self._write(compressed)
+        self._add_entry(sha, offset, binascii.crc32(compressed, crc))
+
+        if self.delta and len(data) <= DELTA_MAX_SIZE:
+            self._window.append((offset, data, depth))
+            if len(self._window) > DELTA_WINDOW:
+                del self._window[0]
+
+    def _add_blob_stream(self, file, size):
+        """
+        Stream a blob from a file into the pack
+
+        @rtype  string or None
+        @return The blob id, or None if the file's length didn't match size,
+            in which case nothing is written
+
+        """
+
+        offset = self._offset
+        header = encode_entry_header(OBJ_BLOB, size)
+        self._write(header)
+        crc = binascii.crc32(header)
+
+        sha = hashlib.sha1("blob %d\0" % size)
+        compressor = zlib.compressobj()
+        length = 0
+        while True:
+            chunk = file.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            length += len(chunk)
+            sha.update(chunk)
+            compressed = compressor.compress(chunk)
+            self._write(compressed)
+            crc = binascii.crc32(compressed, crc)
+
+        compressed = compressor.flush()
+        self._write(compressed)
+        crc = binascii.crc32(compressed, crc)
+
+        sha = sha.hexdigest()
+        if length != size or sha in self._shas:
+            # Throw the entry away
+            self._file.seek(offset)
+            self._file.truncate()
+            self._offset = offset
+            if length != size:
+                return None
+            return sha
+
+        self._add_entry(sha, offset, crc)
+        return sha
+
+    def add_blob_file(self, path, size):
+        """
+        Stream a large file into the pack without holding it in memory
+
+        @type   size: int
+        @param  size: The file size, from a stat call
+
+        @rtype  string
+        @return The blob id
+
+        """
+
+        file = open(path, "rb")
+        try:
+            sha = self._add_blob_stream(file, size)
+            if sha is None:
+                # The file changed size while it was read, so a copy of
+                # whatever it holds now is written instead
+                file.seek(0)
+                (copy, size) = copy_to_temp_file(file, self.pack_dir, STREAM_CHUNK_SIZE)
+                try:
+                    sha = self._add_blob_stream(copy, size)
+                finally:
+                    copy.close()
+        finally:
+            file.close()
+
+        return sha
+
+    def _write_index(self, path, pack_checksum):
+        entries = sorted(self._entries)
+
+        fanout = [0] * 256
+        for (sha, offset, crc) in entries:
+            fanout[ord(sha[0])] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        data = ["\377tOc", struct.pack(">L", PACK_INDEX_VERSION)]
+        data.append(struct.pack(">256L", *fanout))
+        data += [sha for (sha, offset, crc) in entries]
+        data += [struct.pack(">L", crc) for (sha, offset, crc) in entries]
+
+        large_offsets = []
+        for (sha, offset, crc) in entries:
+            if offset < 0x80000000:
+                data.append(struct.pack(">L", offset))
+            else:
+                data.append(struct.pack(">L", 0x80000000 | len(large_offsets)))
+                large_offsets.append(struct.pack(">Q", offset))
+        data += large_offsets
+        data.append(pack_checksum)
+
+        data = "".join(data)
+        file = open(path, "wb")
+        try:
+            file.write(data)
+            file.write(hashlib.sha1(data).digest())
+            file.flush()
+            os.fsync(file.fileno())
+        finally:
+            file.close()
+
+    def finish(self):
+        """
+        Complete the pack and its index and move them into place, the index
+        first.  Readers find packs by their .pack files and expect the index
+        to be there already, so a pack must never appear without its index.
+
+        @rtype  string or None
+        @return The path of the pack, without its extension, or None if
+            nothing was written
+
+        """
+
+        if not self._entries:
+            self.abort()
+            return None
+
+        self._file.seek(0)
+        self._file.write(struct.pack(">4sLL", "PACK", PACK_VERSION, len(self._entries)))
+
+        # The checksum covers the header, which has only just been filled
+        # in, so the pack is read back to compute it
+        self._file.seek(0)
+        sha = hashlib.sha1()
+        while True:
+            chunk = self._file.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+        pack_checksum = sha.digest()
+
+        self._file.seek(0, 2)
+        self._file.write(pack_checksum)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+        basename = os.path.join(self.pack_dir, "pack-%s" % binascii.hexlify(pack_checksum))
+        index_path = self._path + ".idx"
+        try:
+            self._write_index(index_path, pack_checksum)
+            os.rename(index_path, basename + ".idx")
+            index_path = basename + ".idx"
+            os.rename(self._path, basename + ".pack")
+        except:
+            for path in (self._path, index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+        return basename
+
+    def abort(self):
+        """
+        Throw the pack away
+
+        """
+
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
@@ -0,0 +1,148 @@
+#
+# untracked.py
+#
+
+from time import time
+
+from gittyup.util import read_data_file, write_data_file
+
+UNTRACKED_CACHE_VERSION = 3
+
+# Directories modified this recently may change again without their mtime
+# changing, so they are not cached
+UNTRACKED_CACHE_RACY_SECONDS = 2
+
+def _is_number(value):
+    return type(value) in (int, long, float)
+
+def _is_valid_record(rel_dir, record):
+    """
+    Check the shape of a directory's record as read from the cache file
+
+    """
+
+    (mtime, has_gitignore, ignore_key, entries) = record
+    if type(rel_dir) != str or not _is_number(mtime) or type(has_gitignore) != bool:
+        return False
+
+    for (gitignore_dir, (gitignore_mtime, gitignore_size)) in ignore_key:
+        if type(gitignore_dir) != str or not _is_number(gitignore_mtime) or not _is_number(gitignore_size):
+            return False
+
+    for (key, name, d_type) in entries:
+        if type(key) != str or type(name) != str or type(d_type) != int:
+            return False
+
+    return True
+
+class UntrackedCache:
+    def __init__(self, path, ignore_key):
+        """
+        Remembers the unignored entries of each working tree directory, so a
+        directory whose mtime hasn't changed can be walked without reading
+        it again.  The cache is stored in a file in the git control
+        directory.
+
+        @type   path: string
+        @param  path: The cache file
+
+        @type   ignore_key: string
+        @param  ignore_key: Identifies the global ignore patterns.  The
+            cache is discarded if they change.
+
+        """
+
+        self.path = path
+        self.ignore_key = ignore_key
+        self.directories = {}
+        self.dirty = False
+        self.read()
+
+    def read(self):
+        data = read_data_file(self.path)
+        if data is None:
+            return
+
+        # A cache that isn't in the expected shape is just rebuilt
+        try:
+            (version, ignore_key, directories) = data
+            if version != UNTRACKED_CACHE_VERSION or ignore_key != self.ignore_key:
+                return
+            for (rel_dir, record) in directories.items():
+                if not _is_valid_record(rel_dir, record):
+                    return
+        except (TypeError, ValueError, AttributeError):
+            return
+
+        self.directories = directories
+
+    def write(self):
+        """
+        Write the cache atomically, if anything has changed
+
+        """
+
+        if not self.dirty:
+            return
+
+        write_data_file(self.path, (UNTRACKED_CACHE_VERSION, self.ignore_key, self.directories))
+        self.dirty = False
+
+    def get(self, rel_dir, mtime):
+        """
+        Look up a directory
+
+        @type   rel_dir: string
+        @param  rel_dir: A repository-relative directory
+
+        @type   mtime: float
+        @param  mtime: The directory's current mtime
+
+        @rtype  tuple or None
+        @return A (has_gitignore, ignore_key, entries) tuple, or None if the
+            directory has changed since it was cached
+
+        """
+
+        record = self.directories.get(rel_dir)
+        if record is None or record[0] != mtime:
+            return None
+
+        return record[1:]
+
+    def set(self, rel_dir, mtime, has_gitignore, ignore_key, entries):
+        """
+        Store the entries of a directory
+
+        @type   has_gitignore: boolean
+        @param  has_gitignore: Whether the directory has a .gitignore file
+
+        @type   ignore_key: tuple
+        @param  ignore_key: Identifies the .gitignore files that were used to
+            filter the entries
+
+        @type   entries: list
+        @param  entries: Sorted (sort key, name, d_type) tuples for the
+            unignored entries
+
+        """
+
+        if time() - mtime < UNTRACKED_CACHE_RACY_SECONDS:
+            if rel_dir in self.directories:
+                del self.directories[rel_dir]
+                self.dirty = True
+            return
+
+        self.directories[rel_dir] = (mtime, has_gitignore, ignore_key, entries)
+        self.dirty = True
+
+    def prune(self, seen):
+        """
+        Forget directories that were not seen by a full walk
+
+        """
+
+        for rel_dir in self.directories.keys():
+            if rel_dir not in seen:
+                del self.directories[rel_dir]
+                self.dirty = True
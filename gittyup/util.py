@@ -3,6 +3,23 @@
 #
 
 import os
+import stat
+import json
+import bisect
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Kinds of directory entries, with the values of d_type in struct dirent
+DT_UNKNOWN = 0
+DT_DIR = 4
+DT_REG = 8
+DT_LNK = 10
 
 def splitall(path):
     """Split a path into all of its parts.
@@ -64,3 +81,124 @@ def get_transport_and_path(uri):
             return transport(host), "/"+path
     # if its not git or git+ssh, try a local url..
     return SubprocessGitClient(), uri
+
+def get_path_bounds(sorted_paths, path, lo=0, hi=None):
+    """Find 'path' and the paths below it in a sorted list, using a binary
+    search within sorted_paths[lo:hi].
+
+    Return an (exact, start, end) tuple.  exact is the position of 'path'
+    itself, or None, and the paths below it are sorted_paths[start:end].
+    Paths like 'foo-bar' or 'foo.txt' sort between 'foo' and 'foo/', so
+    the exact match and the children are looked up separately.
+    """
+    if hi is None:
+        hi = len(sorted_paths)
+
+    i = bisect.bisect_left(sorted_paths, path, lo, hi)
+    exact = None
+    if i < hi and sorted_paths[i] == path:
+        exact = i
+
+    # '0' is the character after '/'
+    start = bisect.bisect_left(sorted_paths, path + "/", i, hi)
+    end = bisect.bisect_left(sorted_paths, path + "0", start, hi)
+    return (exact, start, end)
+
+def get_path_range(sorted_paths, path):
+    """Return the paths from a sorted list that are 'path' itself or are
+    below it, using a binary search.
+    """
+    if path == "":
+        return sorted_paths
+
+    (exact, start, end) = get_path_bounds(sorted_paths, path)
+    result = []
+    if exact is not None:
+        result.append(path)
+    result.extend(sorted_paths[start:end])
+    return result
+
+def _from_json(value):
+    if isinstance(value, unicode):
+        return value.encode("latin-1")
+    elif isinstance(value, list):
+        return tuple([_from_json(item) for item in value])
+    elif isinstance(value, dict):
+        return dict([(_from_json(k), _from_json(v)) for (k, v) in value.items()])
+    return value
+
+def read_data_file(path):
+    """Read a cache file written by write_data_file().  Only plain data is
+    read, never code, so a file planted in a repository is harmless.
+    Strings come back as byte strings and lists as tuples.  Returns None if
+    the file is missing or isn't valid, and callers must still check the
+    shape of what they get.
+    """
+    try:
+        file = open(path, "rb")
+    except IOError:
+        return None
+
+    try:
+        try:
+            return _from_json(json.load(file))
+        except ValueError:
+            return None
+    finally:
+        file.close()
+
+def write_data_file(path, data):
+    """Write nested tuples, lists, dicts, strings and numbers to a cache
+    file atomically, as JSON.  Byte strings are written as latin-1 so that
+    paths that aren't valid UTF-8 come back unchanged.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    file = open(tmp_path, "wb")
+    try:
+        json.dump(data, file, encoding="latin-1", separators=(",", ":"))
+    finally:
+        file.close()
+
+    os.rename(tmp_path, path)
+
+def get_d_type(mode):
+    """Return the DT_* kind of a file from its st_mode.  Anything that
+    isn't a directory, regular file or symlink is DT_UNKNOWN.
+    """
+    if stat.S_ISREG(mode):
+        return DT_REG
+    elif stat.S_ISDIR(mode):
+        return DT_DIR
+    elif stat.S_ISLNK(mode):
+        return DT_LNK
+    return DT_UNKNOWN
+
+def scan_directory(path):
+    """Yield a (name, stat_result, d_type) tuple for each entry of a
+    directory, without following symlinks.
+
+    With scandir, the kind of each entry usually comes from the directory
+    itself without a stat call, and stat_result is None.  Otherwise each
+    entry is lstat()ed and the result is passed along so it needn't be
+    read again.
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_symlink():
+                d_type = DT_LNK
+            elif entry.is_dir(follow_symlinks=False):
+                d_type = DT_DIR
+            elif entry.is_file(follow_symlinks=False):
+                d_type = DT_REG
+            else:
+                d_type = DT_UNKNOWN
+            yield (entry.name, None, d_type)
+        return
+
+    for name in os.listdir(path):
+        try:
+            st = os.lstat(os.path.join(path, name))
+        except OSError:
+            # Removed since the directory was listed
+            continue
+        yield (name, st, get_d_type(st.st_mode))
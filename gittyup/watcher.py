@@ -0,0 +1,580 @@
+#
+# watcher.py
+#
+
+import os
+import stat
+import errno
+import bisect
+import struct
+import select
+import ctypes
+import ctypes.util
+from time import time
+
+import gittyup.util
+from gittyup.exceptions import GittyupWatcherError
+from gittyup.objects import *
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WORKING_TREE_EVENTS = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+    | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+CONTROL_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = "iIII"
+EVENT_HEADER_SIZE = struct.calcsize(EVENT_HEADER)
+EVENT_BUFFER_SIZE = 65536
+
+# Kinds of watched directories
+WATCH_WORKING_TREE = 0
+WATCH_CONTROL = 1
+WATCH_REFS = 2
+
+class _Inotify:
+    """
+    A minimal ctypes binding to the Linux inotify API
+
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise GittyupWatcherError("The C library could not be found")
+
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init"):
+            raise GittyupWatcherError("inotify is not supported on this system")
+
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = self._libc.inotify_init()
+        if self.fd < 0:
+            raise GittyupWatcherError(os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """
+        Read all pending events without blocking
+
+        @rtype  list
+        @return A list of (wd, mask, cookie, name) tuples
+
+        """
+
+        events = []
+        while select.select([self.fd], [], [], 0)[0]:
+            data = os.read(self.fd, EVENT_BUFFER_SIZE)
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = struct.unpack_from(EVENT_HEADER, data, offset)
+                offset += EVENT_HEADER_SIZE
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class GittyupWatcher:
+    def __init__(self, client, callback=None):
+        """
+        Keeps the status of a working copy up to date using inotify.  A
+        baseline status is taken once, and afterwards only the paths that
+        inotify reports as changed are looked at again.
+
+        @type   client: GittyupClient
+        @param  client: A client for the repository to watch
+
+        @type   callback: function
+        @param  callback: Called after statuses change, with a dict mapping
+            each changed repository-relative path to its new GittyupStatus,
+            or to None if the path no longer has a status
+
+        """
+
+        self.client = client
+        self.callback = callback
+
+        # File statuses by repository-relative path, and their sorted paths
+        self.statuses = {}
+        self._paths = []
+
+        # Walked directories, and the number of changed files below each
+        self._directories = set()
+        self._changed_counts = {}
+
+        # The sorted directories that hold index entries.  They are watched
+        # even if they are ignored and so not walked.
+        self._tracked_directories = []
+
+        self._inotify = None
+        self._watches = {}
+        self._watched_directories = {}
+
+        self._snapshot = None
+
+    #
+    # Start Private Methods
+    #
+
+    def _is_changed(self, st):
+        return (st.identifier != "normal" and st.identifier != "untracked")
+
+    def _update_changed_counts(self, path, delta, changes):
+        d = os.path.dirname(path)
+        while True:
+            count = self._changed_counts.get(d, 0) + delta
+            if count:
+                self._changed_counts[d] = count
+            else:
+                del self._changed_counts[d]
+
+            # The directory's status flips when its count crosses zero
+            if d in self._directories and (count == 0 or count == delta):
+                changes[d] = self.get_status(d)
+
+            if d == "":
+                break
+            d = os.path.dirname(d)
+
+    def _set_status(self, path, st, changes, add_path=True):
+        """
+        Record a path's status, or forget the path if st is None
+
+        @type   add_path: boolean
+        @param  add_path: Insert a new path into the sorted paths.  The
+            caller may instead add many new paths at once.
+
+        """
+
+        old = self.statuses.get(path)
+        if old is not None and st is not None:
+            if old.identifier == st.identifier and old.is_staged == st.is_staged:
+                return
+
+        if old is None:
+            if add_path:
+                bisect.insort(self._paths, path)
+        elif self._is_changed(old):
+            self._update_changed_counts(path, -1, changes)
+
+        if st is None:
+            del self._paths[bisect.bisect_left(self._paths, path)]
+            del self.statuses[path]
+        else:
+            self.statuses[path] = st
+            if self._is_changed(st):
+                self._update_changed_counts(path, 1, changes)
+
+        changes[path] = st
+
+    def _normalize_scopes(self, scopes):
+        normalized = []
+        for scope in sorted(scopes):
+            if normalized and (normalized[-1] == "" or scope == normalized[-1] or scope.startswith(normalized[-1] + "/")):
+                continue
+            normalized.append(scope)
+
+        return normalized
+
+    def _refresh(self, scopes, changes):
+        """
+        Recompute the statuses at or below the given repository-relative
+        paths and start watching any new directories
+
+        """
+
+        scopes = self._normalize_scopes(scopes)
+        if not scopes:
+            return
+
+        started = time()
+        directories = []
+        paths = [self.client.get_absolute_path(scope) for scope in scopes]
+        statuses = {}
+        for st in self.client._iter_file_statuses(paths, directories, self._snapshot):
+            statuses[st.path] = st
+
+        # The stale paths are collected before any are removed
+        stale = []
+        for scope in scopes:
+            for path in gittyup.util.get_path_range(self._paths, scope):
+                if path not in statuses:
+                    stale.append(path)
+
+        for path in stale:
+            self._set_status(path, None, changes)
+
+        # Inserting each path of the baseline in turn would be quadratic,
+        # so they are sorted once instead
+        baseline = not self._paths
+        for st in statuses.values():
+            self._set_status(st.path, st, changes, not baseline)
+        if baseline:
+            self._paths = sorted(statuses)
+
+        # Forget the directories that were removed or are now ignored
+        directories = set(directories)
+        for scope in scopes:
+            if scope in self._directories:
+                for d in list(self._directories):
+                    if (scope == "" or d == scope or d.startswith(scope + "/")) and d not in directories:
+                        self._directories.remove(d)
+                        if not self._is_tracked_directory(d):
+                            self._unwatch_directory(d)
+                        changes[d] = None
+
+        new_directories = []
+        for d in directories:
+            if d not in self._directories:
+                self._directories.add(d)
+                changes[d] = self.get_status(d)
+            if self._watch_directory(d):
+                new_directories.append(d)
+
+        # Files created in a new directory before it was watched were
+        # missed, so look at recently modified new directories again
+        recent = []
+        for d in new_directories:
+            try:
+                if os.stat(self.client.get_absolute_path(d)).st_mtime >= started - 1:
+                    recent.append(d)
+            except OSError:
+                pass
+
+        # A tracked file can be in an ignored directory, which isn't walked,
+        # so the directories holding index entries are watched as well
+        for scope in scopes:
+            for d in gittyup.util.get_path_range(self._tracked_directories, scope):
+                self._watch_directory(d)
+
+        if recent:
+            self._refresh(recent, changes)
+
+    def _is_tracked_directory(self, rel_dir):
+        i = bisect.bisect_left(self._tracked_directories, rel_dir)
+        return i < len(self._tracked_directories) and self._tracked_directories[i] == rel_dir
+
+    def _update_tracked_directories(self):
+        """
+        Watch the directories that hold index entries in the current
+        snapshot, and stop watching the ones that no longer do, unless
+        they are walked.  The top directory is always watched.
+
+        """
+
+        index_paths = self._snapshot[3]
+        tracked = set([os.path.dirname(path) for path in index_paths])
+        tracked.discard("")
+
+        old_tracked = set(self._tracked_directories)
+        for d in old_tracked - tracked:
+            if d not in self._directories:
+                self._unwatch_directory(d)
+        for d in tracked - old_tracked:
+            self._watch_directory(d)
+
+        self._tracked_directories = sorted(tracked)
+
+    def _watch_directory(self, rel_dir):
+        if rel_dir in self._watched_directories:
+            return False
+
+        absolute_path = self.client.get_absolute_path(rel_dir)
+        try:
+            wd = self._inotify.add_watch(absolute_path, WORKING_TREE_EVENTS | IN_ONLYDIR | IN_DONT_FOLLOW)
+        except OSError, e:
+            if e.errno == errno.ENOSPC:
+                raise GittyupWatcherError("Too many directories to watch, raise fs.inotify.max_user_watches")
+
+            # Symlinks and directories that have already gone away
+            return False
+
+        self._watches[wd] = (WATCH_WORKING_TREE, rel_dir)
+        self._watched_directories[rel_dir] = wd
+        return True
+
+    def _unwatch_directory(self, rel_dir):
+        wd = self._watched_directories.pop(rel_dir, None)
+        if wd is not None:
+            self._inotify.rm_watch(wd)
+            self._watches.pop(wd, None)
+
+    def _watch_control_directory(self):
+        controldir = self.client.repo.controldir()
+        wd = self._inotify.add_watch(controldir, CONTROL_EVENTS | IN_ONLYDIR)
+        self._watches[wd] = (WATCH_CONTROL, "")
+
+        for root, dirs, files in os.walk(os.path.join(controldir, "refs")):
+            wd = self._inotify.add_watch(root, CONTROL_EVENTS | IN_ONLYDIR)
+            self._watches[wd] = (WATCH_REFS, root)
+
+    def _diff_index(self, old_index, old_paths, new_index, new_paths):
+        """
+        Find the paths whose staged blob or mode changed between two
+        versions of the index
+
+        """
+
+        changed = []
+        old_paths = iter(old_paths)
+        new_paths = iter(new_paths)
+        old_path = next(old_paths, None)
+        new_path = next(new_paths, None)
+        while old_path is not None or new_path is not None:
+            if new_path is None or (old_path is not None and old_path < new_path):
+                changed.append(old_path)
+                old_path = next(old_paths, None)
+            elif old_path is None or new_path < old_path:
+                changed.append(new_path)
+                new_path = next(new_paths, None)
+            else:
+                old_entry = old_index[old_path]
+                new_entry = new_index[new_path]
+                if old_entry[8] != new_entry[8] or old_entry[4] != new_entry[4]:
+                    changed.append(new_path)
+                old_path = next(old_paths, None)
+                new_path = next(new_paths, None)
+
+        return changed
+
+    def _diff_trees(self, old_tree, new_tree, prefix, changed):
+        """
+        Find the paths that differ between two trees, skipping subtrees
+        that are identical.  A path that is a tree on only one side is
+        returned as a whole.
+
+        """
+
+        if old_tree.id == new_tree.id:
+            return
+
+        old_entries = {}
+        for (name, mode, sha) in old_tree.iteritems():
+            old_entries[name] = (mode, sha)
+
+        repo = self.client.repo
+        for (name, mode, sha) in new_tree.iteritems():
+            path = prefix + name
+            old_entry = old_entries.pop(name, None)
+            if old_entry == (mode, sha):
+                continue
+
+            if old_entry is not None and stat.S_ISDIR(mode) and stat.S_ISDIR(old_entry[0]):
+                self._diff_trees(repo[old_entry[1]], repo[sha], path + "/", changed)
+            else:
+                changed.append(path)
+
+        for name in old_entries:
+            changed.append(prefix + name)
+
+    #
+    # Start Public Methods
+    #
+
+    def start(self):
+        """
+        Start watching the working copy and take the baseline status
+
+        """
+
+        self._inotify = _Inotify()
+        self._watch_control_directory()
+        self._watch_directory("")
+        self._snapshot = self.client._get_status_snapshot()
+        self._update_tracked_directories()
+        self._refresh([""], {})
+
+    def stop(self):
+        """
+        Stop watching the working copy
+
+        """
+
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+            self._watches = {}
+            self._watched_directories = {}
+            self._tracked_directories = []
+
+    def fileno(self):
+        """
+        The inotify file descriptor, for use with select() or a main loop.
+        Call process_events() when it becomes readable.
+
+        """
+
+        return self._inotify.fd
+
+    def process_events(self, timeout=0):
+        """
+        Apply the pending changes to the working copy, index and HEAD
+
+        @type   timeout: float
+        @param  timeout: How long to wait for events, in seconds.  None
+            waits until there are events.
+
+        @rtype  dict
+        @return A dict mapping each changed repository-relative path to its
+            new GittyupStatus, or to None if the path no longer has a status
+
+        """
+
+        if not select.select([self._inotify.fd], [], [], timeout)[0]:
+            return {}
+
+        scopes = set()
+        index_changed = False
+        head_changed = False
+        overflow = False
+        for (wd, mask, cookie, name) in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+
+            watch = self._watches.get(wd)
+            if watch is None:
+                continue
+            (kind, rel_dir) = watch
+
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                if kind == WATCH_WORKING_TREE and self._watched_directories.get(rel_dir) == wd:
+                    del self._watched_directories[rel_dir]
+                continue
+
+            if kind == WATCH_CONTROL:
+                if name == "index":
+                    index_changed = True
+                elif name == "HEAD" or name == "packed-refs":
+                    head_changed = True
+            elif kind == WATCH_REFS:
+                head_changed = True
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    refs_dir = os.path.join(rel_dir, name)
+                    new_wd = self._inotify.add_watch(refs_dir, CONTROL_EVENTS | IN_ONLYDIR)
+                    self._watches[new_wd] = (WATCH_REFS, refs_dir)
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                scopes.add(rel_dir)
+            elif mask & IN_ISDIR and not mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                # Attribute changes on a subdirectory don't change any status
+                continue
+            elif name == ".gitignore":
+                # Anything in the directory may now be ignored or not
+                scopes.add(rel_dir)
+            elif name and not (rel_dir == "" and name == ".git"):
+                scopes.add(os.path.join(rel_dir, name))
+
+        changes = {}
+        if overflow:
+            self._snapshot = self.client._get_status_snapshot()
+            self._update_tracked_directories()
+            self._refresh([""], changes)
+        else:
+            if index_changed or head_changed:
+                old_snapshot = self._snapshot
+                self._snapshot = self.client._get_status_snapshot()
+                self._update_tracked_directories()
+                (old_tree, old_index, old_index_mtime, old_paths) = old_snapshot
+                (new_tree, new_index, new_index_mtime, new_paths) = self._snapshot
+                scopes.update(self._diff_index(old_index, old_paths, new_index, new_paths))
+
+                changed = []
+                self._diff_trees(old_tree, new_tree, "", changed)
+                scopes.update(changed)
+
+            self._refresh(scopes, changes)
+
+        if changes and self.callback:
+            self.callback(changes)
+
+        return changes
+
+    def run(self):
+        """
+        Process events until stop() is called
+
+        """
+
+        while self._inotify is not None:
+            self.process_events(None)
+
+    def get_status(self, path):
+        """
+        Look up the current status of a file or directory
+
+        @type   path: string
+        @param  path: A repository-relative path
+
+        @rtype  GittyupStatus
+        @return The status, or None if the path is unknown or ignored
+
+        """
+
+        st = self.statuses.get(path)
+        if st is not None:
+            return st
+
+        if path in self._directories:
+            if path in self._changed_counts:
+                return ModifiedStatus(path)
+            return NormalStatus(path)
+
+        return None
+
+    def get_statuses(self, scopes=None):
+        """
+        Get the current statuses of all files and directories, like
+        GittyupClient.status()
+
+        @type   scopes: list
+        @param  scopes: Repository-relative paths.  If given, only the
+            statuses at or below them are returned.
+
+        """
+
+        paths = self._paths
+        directories = sorted(self._directories)
+        if scopes is not None:
+            scopes = self._normalize_scopes(scopes)
+            paths = []
+            scoped_directories = []
+            for scope in scopes:
+                paths += gittyup.util.get_path_range(self._paths, scope)
+                scoped_directories += gittyup.util.get_path_range(directories, scope)
+            directories = scoped_directories
+
+        statuses = [self.statuses[path] for path in paths]
+        for d in directories:
+            statuses.append(self.get_status(d))
+
+        return statuses
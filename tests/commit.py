@@ -3,10 +3,13 @@
 #
 
 import os
+import cPickle
 from shutil import rmtree
 from sys import argv
 from optparse import OptionParser
 
+from dulwich.index import commit_index
+
 from gittyup.client import GittyupClient
 from gittyup.objects import *
 from util import touch, change
@@ -39,4 +42,55 @@ else:
     g.stage([DIR+"/test1.txt"])
     g.commit("Second commit", author="Alex Plumb <alexplumb@gmail.com>")
     
+    # Cached trees of unchanged directories are reused, and the trees built
+    # match those built from the whole index
+    os.makedirs(DIR + "/a/b")
+    os.mkdir(DIR + "/c")
+    touch(DIR + "/a/b/test3.txt")
+    touch(DIR + "/c/test4.txt")
+    g.stage([DIR+"/a/b/test3.txt", DIR+"/c/test4.txt"])
+    g.commit("Third commit")
+    
+    change(DIR + "/a/b/test3.txt")
+    g.stage([DIR+"/a/b/test3.txt"])
+    cache = g._get_cache_tree()
+    assert ("c" in cache.trees)
+    assert ("a/b" not in cache.trees and "a" not in cache.trees and "" not in cache.trees)
+    sha = g.commit("Fourth commit")
+    assert (g.repo[sha].tree == commit_index(g.repo.object_store, g._get_index()))
+    
+    g.remove([DIR+"/c/test4.txt"])
+    sha = g.commit("Fifth commit")
+    assert (g.repo[sha].tree == commit_index(g.repo.object_store, g._get_index()))
+    
+    # A write from an index that another client has replaced since it was
+    # read doesn't keep the trees cached for the other client's index
+    os.mkdir(DIR + "/d")
+    touch(DIR + "/d/test5.txt")
+    g.stage([DIR+"/d/test5.txt"])
+    g.commit("Sixth commit")
+    g2 = GittyupClient(DIR)
+    index = g2._get_index()
+    change(DIR + "/d/test5.txt")
+    g.stage([DIR+"/d/test5.txt"])
+    g.commit("Seventh commit")
+    del index["a/b/test3.txt"]
+    g2._write_index(index, ["a/b/test3.txt"])
+    g = GittyupClient(DIR)
+    sha = g.commit("Eighth commit")
+    assert (g.repo[sha].tree == commit_index(g.repo.object_store, g._get_index()))
+    
+    # The cache file is only ever read as data
+    class Payload(object):
+        def __reduce__(self):
+            return (os.mkdir, (DIR+"/payload",))
+    file = open(DIR+"/.git/gittyup-cache-tree", "wb")
+    cPickle.dump(Payload(), file, cPickle.HIGHEST_PROTOCOL)
+    file.close()
+    g = GittyupClient(DIR)
+    g.stage([DIR+"/a/b/test3.txt"])
+    sha = g.commit("Ninth commit")
+    assert (g.repo[sha].tree == commit_index(g.repo.object_store, g._get_index()))
+    assert (not os.path.exists(DIR+"/payload"))
+    
     print "commit.py pass"
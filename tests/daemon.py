@@ -0,0 +1,92 @@
+#
+# test/daemon.py
+#
+
+import os
+import threading
+from shutil import rmtree
+from sys import argv
+from optparse import OptionParser
+
+from gittyup.client import GittyupClient
+from gittyup.daemon import GittyupDaemon, GittyupDaemonClient
+from gittyup.exceptions import GittyupDaemonError
+from gittyup.objects import *
+from util import touch, change
+
+parser = OptionParser()
+parser.add_option("-c", "--cleanup", action="store_true", default=False)
+(options, args) = parser.parse_args(argv)
+
+DIR = "daemon"
+
+if options.cleanup:
+    rmtree(DIR, ignore_errors=True)
+
+    print "daemon.py clean"
+else:
+    if os.path.isdir(DIR):
+        raise SystemExit("This test script has already been run.  Please call this script with --cleanup to start again")
+
+    os.mkdir(DIR)
+    g = GittyupClient()
+    g.initialize_repository(DIR)
+    
+    os.mkdir(DIR + "/fol")
+    touch(DIR + "/fol/test1.txt")
+    touch(DIR + "/test2.txt")
+    os.mkdir(DIR + "/ign")
+    touch(DIR + "/ign/test4.txt")
+    g.stage([DIR+"/fol/test1.txt", DIR+"/test2.txt", DIR+"/ign/test4.txt"])
+    g.commit("Adding test1.txt, test2.txt and test4.txt")
+    f = open(DIR+"/.gitignore", "w")
+    f.write("ign/\n")
+    f.close()
+    
+    try:
+        GittyupDaemonClient(DIR)
+        raise AssertionError("Connected without a daemon")
+    except GittyupDaemonError:
+        pass
+    
+    d = GittyupDaemon(DIR)
+    d.start()
+    running = [True]
+    def serve():
+        while running[0]:
+            d.process(0.1)
+    thread = threading.Thread(target=serve)
+    thread.start()
+    
+    try:
+        c = GittyupDaemonClient(DIR)
+        st = c.status()
+        assert (sorted([(s.path, s.identifier) for s in st]) == sorted([(s.path, s.identifier) for s in g.status()]))
+        assert (c.tracking() == "refs/heads/master")
+        
+        # Changes made after the daemon started are in the next answer
+        change(DIR+"/fol/test1.txt")
+        touch(DIR+"/test3.txt")
+        g.stage([DIR+"/test3.txt"])
+        st = c.status([DIR+"/fol"])
+        assert ([s.path for s in st] == ["fol/test1.txt", "fol"])
+        assert (st[0] == ModifiedStatus)
+        assert (st[1] == ModifiedStatus)
+        assert ([s.path for s in c.status(DIR+"/fol")] == ["fol/test1.txt", "fol"])
+        assert (c.is_staged(DIR+"/test3.txt"))
+        assert (not c.is_staged(DIR+"/fol/test1.txt"))
+        
+        # Tracked files in ignored directories are kept up to date too
+        change(DIR+"/ign/test4.txt")
+        assert ([(s.path, s.identifier) for s in c.status([DIR+"/ign/test4.txt"])] == [("ign/test4.txt", "modified")])
+        g.stage([DIR+"/ign/test4.txt"])
+        assert (c.is_staged(DIR+"/ign/test4.txt"))
+        c.close()
+    finally:
+        running[0] = False
+        thread.join()
+        d.stop()
+    
+    assert (not os.path.exists(DIR+"/.git/gittyup.sock"))
+    
+    print "daemon.py pass"
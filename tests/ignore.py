@@ -0,0 +1,96 @@
+#
+# test/ignore.py
+#
+
+import os
+from shutil import rmtree
+from sys import argv
+from optparse import OptionParser
+
+from gittyup.client import GittyupClient
+from gittyup.ignore import IgnoreMatcher
+from gittyup.objects import *
+from util import touch, change
+
+parser = OptionParser()
+parser.add_option("-c", "--cleanup", action="store_true", default=False)
+(options, args) = parser.parse_args(argv)
+
+DIR = "ignore"
+
+if options.cleanup:
+    rmtree(DIR, ignore_errors=True)
+
+    print "ignore.py clean"
+else:
+    if os.path.isdir(DIR):
+        raise SystemExit("This test script has already been run.  Please call this script with --cleanup to start again")
+
+    m = IgnoreMatcher([
+        "# comment",
+        "*.o",
+        "!keep.o",
+        "build/",
+        "/root.txt",
+        "doc/*.html",
+        "**/tmp",
+        "data[0-9].csv"
+    ])
+    assert (m.match("a.o") == True)
+    assert (m.match("src/a.o") == True)
+    assert (m.match("src/keep.o") == False)
+    assert (m.match("build", True) == True)
+    assert (m.match("build") is None)
+    assert (m.match("root.txt") == True)
+    assert (m.match("src/root.txt") is None)
+    assert (m.match("doc/index.html") == True)
+    assert (m.match("doc/api/index.html") is None)
+    assert (m.match("a/b/tmp", True) == True)
+    assert (m.match("data1.csv") == True)
+    assert (m.match("data10.csv") is None)
+    assert (m.match("comment") is None)
+
+    m = IgnoreMatcher(["/foo"], "sub")
+    assert (m.match("sub/foo") == True)
+    assert (m.match("foo") is None)
+    
+    os.mkdir(DIR)
+    g = GittyupClient()
+    g.initialize_repository(DIR)
+    
+    os.mkdir(DIR + "/build")
+    os.mkdir(DIR + "/src")
+    touch(DIR + "/build/out.txt")
+    touch(DIR + "/src/main.o")
+    touch(DIR + "/src/keep.o")
+    touch(DIR + "/test.txt")
+    f = open(DIR + "/.gitignore", "w")
+    f.write("*.o\nbuild/\n")
+    f.close()
+    f = open(DIR + "/src/.gitignore", "w")
+    f.write("!keep.o\n")
+    f.close()
+    
+    st = g.status()
+    paths = [s.path for s in st if s == UntrackedStatus]
+    assert (paths == [".gitignore", "src/.gitignore", "src/keep.o", "test.txt"])
+    
+    # Changing a .gitignore file invalidates its cached patterns
+    f = open(DIR + "/src/.gitignore", "w")
+    f.write("*.txt\n")
+    f.close()
+    st = g.status()
+    paths = [s.path for s in st if s == UntrackedStatus]
+    assert (paths == [".gitignore", "src/.gitignore", "test.txt"])
+    
+    # Ignored directories are reported as one entry without being read
+    os.mkdir(DIR + "/build/deep")
+    touch(DIR + "/build/deep/out2.txt")
+    st = g.status([], True)
+    ignored = [s.path for s in st if s == IgnoredStatus]
+    assert (ignored == ["build", "src/keep.o", "src/main.o"])
+    assert ([s.path for s in st if s == UntrackedStatus] == paths)
+    assert (dict([(s.path, s) for s in st])[""] == NormalStatus)
+    assert (IgnoredStatus not in g.status())
+    
+    print "ignore.py pass"
@@ -44,6 +44,18 @@ else:
     assert (g.is_staged(DIR+"/fol/test.txt"))
     assert (st[0] == RemovedStatus)
     assert (st[1] == AddedStatus)
+    
+    # Moving a directory leaves siblings that share its name's prefix alone
+    os.mkdir(DIR+"/dir")
+    os.mkdir(DIR+"/dir2")
+    touch(DIR + "/dir/test3.txt")
+    touch(DIR + "/dir2/test3.txt")
+    g.stage([DIR+"/dir/test3.txt", DIR+"/dir2/test3.txt"])
+    g.move(DIR+"/dir", DIR+"/moved")
+    index = g._get_index()
+    assert ("moved/test3.txt" in index and "dir2/test3.txt" in index)
+    assert ("dir/test3.txt" not in index and "moved2/test3.txt" not in index)
+    g.commit("Moving dir")
 
     # Move as children test
     touch(DIR + "/test2.txt")
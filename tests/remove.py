@@ -53,4 +53,17 @@ else:
     assert (not g.is_staged(DIR+"/test.txt"))
     assert (st[0] == NormalStatus)
     
+    # Removing a directory removes the tracked files below it
+    os.mkdir(DIR+"/dir")
+    touch(DIR + "/dir/test2.txt")
+    touch(DIR + "/dir.txt")
+    g.stage([DIR+"/dir/test2.txt", DIR+"/dir.txt"])
+    g.commit("Adding dir")
+    g.remove([DIR+"/dir"])
+    assert (not os.path.exists(DIR+"/dir"))
+    assert (os.path.exists(DIR+"/dir.txt"))
+    assert (g.is_staged(DIR+"/dir/test2.txt"))
+    assert (not g.is_staged(DIR+"/dir.txt"))
+    assert (sorted(g._get_index()) == ["dir.txt", "test.txt"])
+    
     print "remove.py pass"
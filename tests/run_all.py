@@ -18,7 +18,11 @@ modules = [
     "clone.py",
     "move.py",
     "pull.py",
-    "remote.py"
+    "remote.py",
+    "status.py",
+    "ignore.py",
+    "watcher.py",
+    "daemon.py"
 ]
 
 if len(argv) == 2 and  argv[1] == "--cleanup":
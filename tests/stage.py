@@ -2,12 +2,16 @@
 # test/stage.py
 #
 
+from __future__ import with_statement
+
 import os
+import threading
 from shutil import rmtree
 from sys import argv
 from optparse import OptionParser
 
 from gittyup.client import GittyupClient
+from gittyup.exceptions import IndexLockedError, IndexTransactionError
 from gittyup.objects import *
 from util import touch, change
 
@@ -72,4 +76,146 @@ else:
     assert (st[0] == ModifiedStatus)
     assert (st[1] == UntrackedStatus)
     
+    # unstage_all() also restores staged removals and drops added files
+    g.stage([DIR+"/test2.txt"])
+    g.remove([DIR+"/test1.txt"])
+    g.unstage_all()
+    st = g.status()
+    assert ([(s.path, s.identifier, s.is_staged) for s in st[:2]] == [("test1.txt", "missing", False), ("test2.txt", "untracked", False)])
+    change(DIR+"/test1.txt")
+    
+    # stage() reports what it did, and refuses to write a locked index
+    touch(DIR + "/test3.txt")
+    (new, changed, unchanged) = g.stage([DIR+"/test1.txt", DIR+"/test3.txt"])
+    assert (new == ["test3.txt"])
+    assert (changed == ["test1.txt"])
+    assert (unchanged == [])
+    (new, changed, unchanged) = g.stage([DIR+"/test1.txt"])
+    assert (unchanged == ["test1.txt"])
+    
+    open(DIR + "/.git/index.lock", "w").close()
+    try:
+        g.stage([DIR+"/test2.txt"])
+        raise AssertionError("Staged with a locked index")
+    except IndexLockedError:
+        pass
+    os.remove(DIR + "/.git/index.lock")
+    assert (not g.is_staged(DIR+"/test2.txt"))
+
+    # The index is locked from before it is read until it is written
+    locked = []
+    stage_files = g._stage_files
+    def check_lock(*args):
+        locked.append(os.path.exists(DIR + "/.git/index.lock"))
+        return stage_files(*args)
+    g._stage_files = check_lock
+    touch(DIR + "/locked.txt")
+    g.stage([DIR+"/locked.txt"])
+    del g._stage_files
+    assert (locked == [True])
+    assert (not os.path.exists(DIR + "/.git/index.lock"))
+    assert (g.is_staged(DIR+"/locked.txt"))
+    
+    # Bulk staging writes new content into a pack instead of loose objects
+    os.mkdir(DIR + "/bulk")
+    paths = []
+    for i in range(20):
+        path = DIR + "/bulk/file%d.txt" % i
+        file = open(path, "w")
+        file.write("".join(["line %d of a file that is much the same as the others\n" % j for j in range(100)]) + "file %d\n" % i)
+        file.close()
+        paths.append(path)
+    
+    (new, changed, unchanged) = g.stage(paths, use_pack=True, delta=True)
+    assert (len(new) == 20)
+    assert (os.listdir(DIR + "/.git/objects/pack"))
+    
+    index = g._get_index()
+    g2 = GittyupClient(DIR)
+    for path in paths:
+        blob_id = index[g.get_relative_path(path)][8]
+        assert (not os.path.exists(DIR + "/.git/objects/%s/%s" % (blob_id[:2], blob_id[2:])))
+        assert (g2.repo[blob_id].as_raw_string() == open(path).read())
+    
+    # Clients share their hashing threads
+    threads = threading.activeCount()
+    for i in range(5):
+        GittyupClient(DIR).stage([DIR+"/test1.txt", DIR+"/test2.txt"])
+    assert (threading.activeCount() == threads)
+    
+    # A transaction holds the index lock and writes the index once
+    touch(DIR + "/test4.txt")
+    touch(DIR + "/test5.txt")
+    with g.index_transaction():
+        g.stage([DIR+"/test4.txt"])
+        g.stage([DIR+"/test5.txt"])
+        g.unstage([DIR+"/test5.txt"])
+        assert (os.path.exists(DIR + "/.git/index.lock"))
+        assert (g.is_staged(DIR+"/test4.txt"))
+        assert (not GittyupClient(DIR).is_staged(DIR+"/test4.txt"))
+    assert (not os.path.exists(DIR + "/.git/index.lock"))
+    assert (g.is_staged(DIR+"/test4.txt"))
+    assert (not g.is_staged(DIR+"/test5.txt"))
+    
+    # and leaves the index as it was if it fails
+    try:
+        with g.index_transaction():
+            g.stage([DIR+"/test5.txt"])
+            g.unstage([DIR+"/test4.txt"])
+            raise ValueError()
+    except ValueError:
+        pass
+    assert (not os.path.exists(DIR + "/.git/index.lock"))
+    assert (g.is_staged(DIR+"/test4.txt"))
+    assert (not g.is_staged(DIR+"/test5.txt"))
+    
+    # Committing would move HEAD past anything a rollback could undo
+    head = g.repo.head()
+    try:
+        with g.index_transaction():
+            g.stage([DIR+"/test5.txt"])
+            g.commit("Committing in a transaction")
+        raise AssertionError("Committed within a transaction")
+    except IndexTransactionError:
+        pass
+    assert (g.repo.head() == head)
+    assert (not os.path.exists(DIR + "/.git/index.lock"))
+    assert (not g.is_staged(DIR+"/test5.txt"))
+    
+    # Large files are streamed into the object store
+    g.config.set("core", "bigfilethreshold", "1k")
+    path = DIR + "/large.txt"
+    file = open(path, "w")
+    file.write("a large file\n" * 10000)
+    file.close()
+    g.stage([path], use_pack=False)
+    blob_id = g._get_index()["large.txt"][8]
+    assert (os.path.exists(DIR + "/.git/objects/%s/%s" % (blob_id[:2], blob_id[2:])))
+    assert (GittyupClient(DIR).repo[blob_id].as_raw_string() == open(path).read())
+    g.config.set("core", "bigfilethreshold", "512m")
+    
+    # With a split index, a write only holds the entries that changed
+    g.config.set("core", "splitindex", "true")
+    g.config.write()
+    g = GittyupClient(DIR)
+    g.stage([DIR+"/test2.txt"])
+    shared = [name for name in os.listdir(DIR + "/.git") if name.startswith("sharedindex.")]
+    assert (len(shared) == 1)
+    entries = dict(g._get_index().iteritems())
+    
+    change(DIR+"/test2.txt")
+    g.stage([DIR+"/test2.txt"])
+    g.unstage([DIR+"/test3.txt"])
+    assert ([name for name in os.listdir(DIR + "/.git") if name.startswith("sharedindex.")] == shared)
+    index = g._get_index()
+    (deleted, replaced, added) = index.get_split_changes()
+    assert ([index.shared_names[i] for i in deleted] == ["test3.txt"])
+    assert ([index.shared_names[i] for i in replaced] == ["test2.txt"])
+    assert (added == [])
+    assert ("test3.txt" not in index)
+    assert (index["test2.txt"] != entries["test2.txt"])
+    del entries["test3.txt"]
+    del entries["test2.txt"]
+    assert (dict([(name, entry) for (name, entry) in index.iteritems() if name != "test2.txt"]) == entries)
+    
     print "stage.py pass"
@@ -0,0 +1,178 @@
+#
+# test/status.py
+#
+
+import os
+import cPickle
+from shutil import rmtree
+from sys import argv
+from optparse import OptionParser
+
+from gittyup.client import GittyupClient
+from gittyup.batch import status_many
+from gittyup.objects import *
+from util import touch, change
+
+parser = OptionParser()
+parser.add_option("-c", "--cleanup", action="store_true", default=False)
+(options, args) = parser.parse_args(argv)
+
+DIR = "status"
+
+if options.cleanup:
+    rmtree(DIR, ignore_errors=True)
+
+    print "status.py clean"
+else:
+    if os.path.isdir(DIR):
+        raise SystemExit("This test script has already been run.  Please call this script with --cleanup to start again")
+
+    os.mkdir(DIR)
+    g = GittyupClient()
+    g.initialize_repository(DIR)
+    
+    touch(DIR + "/test1.txt")
+    touch(DIR + "/test2.txt")
+    
+    g.stage([DIR+"/test1.txt", DIR+"/test2.txt"])
+    g.commit("Adding test1.txt and test2.txt")
+    st = g.status()
+    assert (st[0] == NormalStatus)
+    assert (st[1] == NormalStatus)
+
+    # A same-size change made in the same second the index was written is
+    # racily clean and must still be detected
+    f = open(DIR+"/test1.txt", "w")
+    f.write("")
+    f.close()
+    change(DIR+"/test2.txt")
+    g.stage([DIR+"/test2.txt"])
+    f = open(DIR+"/test2.txt", "w")
+    f.write("2")
+    f.close()
+    st = g.status()
+    assert (st[0] == NormalStatus)
+    assert (st[1] == ModifiedStatus)
+    
+    # Directories are modified if anything below them is
+    os.makedirs(DIR+"/a/b")
+    touch(DIR+"/a/b/test3.txt")
+    touch(DIR+"/a/test4.txt")
+    g.stage([DIR+"/a/b/test3.txt"])
+    st = g.status()
+    directories = dict([(s.path, s) for s in st if s.path in ("", "a", "a/b")])
+    assert (directories["a/b"] == ModifiedStatus)
+    assert (directories["a"] == ModifiedStatus)
+    assert (directories[""] == ModifiedStatus)
+    
+    d_st = g.get_directory_statuses([NormalStatus("a/test4.txt"), AddedStatus("c/d/test5.txt")])
+    assert ([s.path for s in d_st] == ["", "a", "c", "c/d"])
+    assert (d_st[1] == NormalStatus)
+    assert (d_st[3] == ModifiedStatus)
+    
+    # Scoped status only reports paths inside the given directory
+    touch(DIR+"/a-b.txt")
+    st = g.status([DIR+"/a"])
+    paths = [s.path for s in st]
+    assert (paths == ["a/b/test3.txt", "a/test4.txt", "a/b", "a"])
+    assert (st[0] == AddedStatus)
+    assert (st[1] == UntrackedStatus)
+    assert (st[3] == ModifiedStatus)
+
+    st = g.status([DIR+"/test2.txt"])
+    assert ([s.path for s in st] == ["test2.txt"])
+    assert (st[0] == ModifiedStatus)
+    
+    # iter_status() yields the same statuses, with is_staged set
+    st = g.status()
+    it = list(g.iter_status())
+    assert (sorted([(s.path, s.identifier, s.is_staged) for s in it]) == sorted([(s.path, s.identifier, s.is_staged) for s in st]))
+    first = g.iter_status().next()
+    assert (isinstance(first, GittyupStatus))
+    
+    # is_staged() agrees with get_staged() and sees later index changes
+    staged = g.get_staged()
+    assert ("a/b/test3.txt" in staged and "test2.txt" in staged)
+    assert (g.is_staged(DIR+"/a/b/test3.txt"))
+    assert (not g.is_staged(DIR+"/test1.txt"))
+    assert (not g.is_staged(DIR+"/a/test4.txt", staged))
+    g.stage([DIR+"/a/test4.txt"])
+    assert (g.is_staged(DIR+"/a/test4.txt"))
+    
+    # Unchanged directories are read from the untracked cache
+    os.mkdir(DIR+"/u")
+    touch(DIR+"/u/test6.txt")
+    os.utime(DIR+"/u", (0, 0))
+    st = g.status([DIR+"/u"])
+    assert ([s.path for s in st] == ["u/test6.txt", "u"])
+    assert (os.path.isfile(DIR+"/.git/gittyup-untracked-cache"))
+    g = GittyupClient(DIR)
+    st = g.status([DIR+"/u"])
+    assert ([s.path for s in st] == ["u/test6.txt", "u"])
+    touch(DIR+"/u/test7.txt")
+    st = g.status([DIR+"/u"])
+    assert ([s.path for s in st] == ["u/test6.txt", "u/test7.txt", "u"])
+
+    # The cache file is only ever read as data
+    class Payload(object):
+        def __reduce__(self):
+            return (os.mkdir, (DIR+"/payload",))
+    file = open(DIR+"/.git/gittyup-untracked-cache", "wb")
+    cPickle.dump(Payload(), file, cPickle.HIGHEST_PROTOCOL)
+    file.close()
+    g = GittyupClient(DIR)
+    st = g.status([DIR+"/u"])
+    assert ([s.path for s in st] == ["u/test6.txt", "u/test7.txt", "u"])
+    assert (not os.path.exists(DIR+"/payload"))
+    
+    # Symlinks are hashed by their target and never followed, and other
+    # kinds of files are left out
+    os.mkdir(DIR+"/l")
+    touch(DIR+"/l/target.txt")
+    os.symlink("target.txt", DIR+"/l/link")
+    os.symlink(".", DIR+"/l/dirlink")
+    os.mkfifo(DIR+"/l/fifo")
+    g.stage([DIR+"/l/target.txt", DIR+"/l/link"])
+    g.commit("Adding a symlink")
+    st = g.status([DIR+"/l"])
+    assert ([(s.path, s.identifier) for s in st] == [("l/link", "normal"), ("l/target.txt", "normal"), ("l/dirlink", "untracked"), ("l", "normal")])
+    change(DIR+"/l/target.txt")
+    os.remove(DIR+"/l/link")
+    os.symlink("other.txt", DIR+"/l/link")
+    st = g.status([DIR+"/l"])
+    assert (st[0] == ModifiedStatus)
+    assert (st[1] == ModifiedStatus)
+    
+    # Wholly untracked directories can be reported as one entry, and empty
+    # ones aren't reported
+    os.makedirs(DIR+"/n/new/deep")
+    os.makedirs(DIR+"/n/empty/deeper")
+    touch(DIR+"/n/new/deep/test8.txt")
+    touch(DIR+"/n/new/test9.txt")
+    touch(DIR+"/n/test10.txt")
+    g.stage([DIR+"/n/test10.txt"])
+    st = g.status([DIR+"/n"], collapse_untracked=True)
+    assert ([(s.path, s.identifier) for s in st] == [("n/test10.txt", "added"), ("n/new", "untracked"), ("n", "modified")])
+    st = g.status([DIR+"/n/new"], collapse_untracked=True)
+    assert ([(s.path, s.identifier) for s in st] == [("n/new", "untracked")])
+    assert (len([s for s in g.status([DIR+"/n"]) if s == UntrackedStatus]) == 2)
+    
+    # A tracked file replaced by an untracked directory is only reported once
+    touch(DIR+"/n/test11.txt")
+    g.stage([DIR+"/n/test11.txt"])
+    os.remove(DIR+"/n/test11.txt")
+    os.makedirs(DIR+"/n/test11.txt/deep")
+    touch(DIR+"/n/test11.txt/deep/test12.txt")
+    st = g.status([DIR+"/n/test11.txt"], collapse_untracked=True)
+    assert ([s.path for s in st] == ["n/test11.txt"])
+    
+    # status_many() gives the same statuses as status(), for every repository
+    g2 = GittyupClient()
+    g2.initialize_repository(DIR+"/u")
+    results = dict([(path, (st, error)) for (path, st, error) in status_many([DIR, DIR+"/u", DIR+"/none"], 2)])
+    assert (sorted(results.keys()) == [DIR, DIR+"/none", DIR+"/u"])
+    assert ([(s.path, s.identifier) for s in results[DIR][0]] == [(s.path, s.identifier) for s in g.status()])
+    assert ("test6.txt" in [s.path for s in results[DIR+"/u"][0]])
+    assert (results[DIR+"/none"][0] is None and results[DIR+"/none"][1] is not None)
+    
+    print "status.py pass"
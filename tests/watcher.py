@@ -0,0 +1,91 @@
+#
+# test/watcher.py
+#
+
+import os
+from shutil import rmtree
+from sys import argv
+from optparse import OptionParser
+
+from gittyup.client import GittyupClient
+from gittyup.watcher import GittyupWatcher
+from gittyup.objects import *
+from util import touch, change
+
+parser = OptionParser()
+parser.add_option("-c", "--cleanup", action="store_true", default=False)
+(options, args) = parser.parse_args(argv)
+
+DIR = "watcher"
+
+if options.cleanup:
+    rmtree(DIR, ignore_errors=True)
+
+    print "watcher.py clean"
+else:
+    if os.path.isdir(DIR):
+        raise SystemExit("This test script has already been run.  Please call this script with --cleanup to start again")
+
+    os.mkdir(DIR)
+    g = GittyupClient()
+    g.initialize_repository(DIR)
+    
+    os.mkdir(DIR + "/fol")
+    touch(DIR + "/fol/test1.txt")
+    touch(DIR + "/test2.txt")
+    os.mkdir(DIR + "/ign")
+    touch(DIR + "/ign/test4.txt")
+    g.stage([DIR+"/fol/test1.txt", DIR+"/test2.txt", DIR+"/ign/test4.txt"])
+    g.commit("Adding test1.txt, test2.txt and test4.txt")
+    f = open(DIR+"/.gitignore", "w")
+    f.write("ign/\n")
+    f.close()
+    
+    changed = []
+    w = GittyupWatcher(g, changed.append)
+    w.start()
+    assert (w.get_status("fol/test1.txt") == NormalStatus)
+    assert (w.get_status("fol") == NormalStatus)
+    
+    # Modifying a file updates it and its parent directories
+    change(DIR+"/fol/test1.txt")
+    w.process_events(5)
+    assert (w.get_status("fol/test1.txt") == ModifiedStatus)
+    assert (w.get_status("fol") == ModifiedStatus)
+    assert (w.get_status("") == ModifiedStatus)
+    assert ("fol/test1.txt" in changed[-1])
+    
+    # New directories are watched
+    os.mkdir(DIR + "/new")
+    w.process_events(5)
+    touch(DIR + "/new/test3.txt")
+    w.process_events(5)
+    assert (w.get_status("new/test3.txt") == UntrackedStatus)
+    
+    # Staging is picked up from the index
+    g.stage([DIR+"/new/test3.txt"])
+    w.process_events(5)
+    assert (w.get_status("new/test3.txt") == AddedStatus)
+    assert (w.get_status("new/test3.txt").is_staged)
+    
+    # Commits are picked up from the refs
+    g.commit("Adding test3.txt")
+    w.process_events(5)
+    assert (w.get_status("new/test3.txt") == NormalStatus)
+    assert (not w.get_status("new/test3.txt").is_staged)
+    
+    # Tracked files in ignored directories are still watched
+    assert (w.get_status("ign/test4.txt") == NormalStatus)
+    change(DIR+"/ign/test4.txt")
+    w.process_events(5)
+    assert (w.get_status("ign/test4.txt") == ModifiedStatus)
+    assert (g.status([DIR+"/ign/test4.txt"])[0] == ModifiedStatus)
+    
+    # Deleted files are missing
+    os.remove(DIR + "/test2.txt")
+    w.process_events(5)
+    assert (w.get_status("test2.txt") == MissingStatus)
+    
+    w.stop()
+    
+    print "watcher.py pass"